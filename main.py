@@ -22,10 +22,19 @@ import asyncio
 import os
 import sqlite3
 import csv
-from io import StringIO, BytesIO
-from dataclasses import dataclass
+import inspect
+import time
+import aiosqlite
+import orjson
+from aiosqlitepool import SQLiteConnectionPool
+from aiolimiter import AsyncLimiter
+from io import StringIO
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Tuple, Dict, List
+from typing import Optional, Tuple, Dict, List, Iterator, Callable
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F
@@ -35,7 +44,7 @@ from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
-    FSInputFile
+    BufferedInputFile, InputMediaPhoto, InputMediaAudio
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.filters import Command
@@ -43,6 +52,8 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 # ---------------------- ENV ----------------------
 load_dotenv()
@@ -55,6 +66,13 @@ WRONG_STICKER_ID   = os.getenv("WRONG_STICKER_ID", "").strip()
 CORRECT_ANIM_ID    = os.getenv("CORRECT_ANIM_ID", "").strip()
 WRONG_ANIM_ID      = os.getenv("WRONG_ANIM_ID", "").strip()
 
+# set WEBHOOK_URL (public https base) to receive updates by webhook instead of long polling
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH   = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBAPP_HOST    = os.getenv("WEBAPP_HOST", "0.0.0.0").strip()
+WEBAPP_PORT    = int(os.getenv("WEBAPP_PORT", "8080"))
+
 if not BOT_TOKEN:
     raise SystemExit("❌ BOT_TOKEN is missing in .env")
 if not OWNER_ID:
@@ -64,28 +82,119 @@ if not OWNER_ID:
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher(storage=MemoryStorage())
 
+# ---------------------- Callback routing ----------------------
+# "prefix:..." callbacks resolve through one dict lookup instead of aiogram testing every
+# startswith filter in turn; each route may require an FSM state like the old filters did
+CALLBACK_ROUTES: Dict[str, Tuple[Callable, Optional[State], bool]] = {}
+
+def cb_route(prefix:str, required_state:Optional[State] = None):
+    def deco(fn):
+        wants_state = "state" in fn.__code__.co_varnames[:fn.__code__.co_argcount]
+        CALLBACK_ROUTES[prefix] = (fn, required_state, wants_state)
+        return fn
+    return deco
+
+async def dispatch_callback(cb:CallbackQuery, state:FSMContext):
+    route = CALLBACK_ROUTES.get((cb.data or "").split(":", 1)[0])
+    if not route: return
+    fn, required_state, wants_state = route
+    if required_state is not None and await state.get_state() != required_state.state: return
+    return await (fn(cb, state) if wants_state else fn(cb))
+
+# ---------------------- Outgoing rate limits ----------------------
+# Telegram: ~30 msg/s per bot, 20 msg/min per group, ~1 msg/s per private chat
+GLOBAL_LIMITER = AsyncLimiter(25, 1)
+_chat_limiters: Dict[int, AsyncLimiter] = {}
+
+def chat_limiter(chat_id:int) -> AsyncLimiter:
+    lim = _chat_limiters.get(chat_id)
+    if lim is None:
+        lim = _chat_limiters[chat_id] = AsyncLimiter(20, 60) if chat_id < 0 else AsyncLimiter(1, 1)
+    return lim
+
 async def _celebrate(chat_id:int, is_correct:bool):
+    # cosmetic: drop it rather than queue behind (or starve) publish and score messages
+    if not (chat_limiter(chat_id).has_capacity() and GLOBAL_LIMITER.has_capacity()): return
     try:
-        if is_correct and CORRECT_STICKER_ID:
-            await bot.send_sticker(chat_id, CORRECT_STICKER_ID, disable_notification=True); return
-        if (not is_correct) and WRONG_STICKER_ID:
-            await bot.send_sticker(chat_id, WRONG_STICKER_ID, disable_notification=True); return
-        if is_correct and CORRECT_ANIM_ID:
-            await bot.send_animation(chat_id, CORRECT_ANIM_ID, disable_notification=True); return
-        if (not is_correct) and WRONG_ANIM_ID:
-            await bot.send_animation(chat_id, WRONG_ANIM_ID, disable_notification=True); return
+        async with chat_limiter(chat_id), GLOBAL_LIMITER:
+            if is_correct and CORRECT_STICKER_ID:
+                await bot.send_sticker(chat_id, CORRECT_STICKER_ID, disable_notification=True); return
+            if (not is_correct) and WRONG_STICKER_ID:
+                await bot.send_sticker(chat_id, WRONG_STICKER_ID, disable_notification=True); return
+            if is_correct and CORRECT_ANIM_ID:
+                await bot.send_animation(chat_id, CORRECT_ANIM_ID, disable_notification=True); return
+            if (not is_correct) and WRONG_ANIM_ID:
+                await bot.send_animation(chat_id, WRONG_ANIM_ID, disable_notification=True); return
     except Exception:
         pass
 
 # ---------------------- DB Helpers ----------------------
-def db() -> sqlite3.Connection:
+# applied once per new connection: WAL readers don't block the writer,
+# NORMAL sync is safe under WAL, 64 MiB page cache + 256 MiB mmap keep hot pages in memory
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+# per-connection LRU of prepared statements keyed on SQL text (sqlite3's own cache)
+STMT_CACHE_SIZE = 100
+
+# hot statements as shared constants so every call site hits the same cache entry
+SQL_INS_SENT = "INSERT INTO sent_msgs(chat_id, quiz_id, message_id, expires_at) VALUES (?,?,?,?)"
+SQL_INS_OPT = "INSERT INTO options(question_id, option_index, text, is_correct) VALUES (?,?,?,?)"
+SQL_INS_QATT = "INSERT INTO question_attachments(question_id, kind, file_id, position) VALUES (?,?,?,?)"
+SQL_INS_BATT = "INSERT INTO media_bundle_attachments(bundle_id, kind, file_id, position) VALUES (?,?,?,?)"
+SQL_UPD_OPT_CORRECT = "UPDATE options SET is_correct = CASE WHEN option_index=? THEN 1 ELSE 0 END WHERE question_id=?"
+
+def _connect() -> sqlite3.Connection:
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
+    for p in SQLITE_PRAGMAS: conn.execute(p)
     return conn
 
+# one-shot sync connection for startup schema work; handlers use the pool below
+@contextmanager
+def db() -> Iterator[sqlite3.Connection]:
+    conn = _connect()
+    try:
+        with conn: yield conn
+    finally:
+        conn.close()
+
+async def _pool_connect() -> aiosqlite.Connection:
+    # autocommit: single statements commit on their own, multi-statement writes use explicit BEGIN
+    conn = await aiosqlite.connect(DB_PATH, cached_statements=STMT_CACHE_SIZE, isolation_level=None)
+    conn.row_factory = aiosqlite.Row
+    for p in SQLITE_PRAGMAS: await conn.execute(p)
+    return conn
+
+# long-lived connections shared by all handlers (hot page cache, no connect per call)
+pool = SQLiteConnectionPool(_pool_connect, pool_size=5)
+
+async def fetch_rows(sql:str, params:tuple=()) -> List[sqlite3.Row]:
+    """Run a read-only statement on a pooled connection; repeated SQL text reuses its prepared statement."""
+    async with pool.connection() as conn:
+        return list(await conn.execute_fetchall(sql, params))
+
+async def fetch_one(sql:str, params:tuple=()) -> Optional[sqlite3.Row]:
+    async with pool.connection() as conn:
+        async with conn.execute(sql, params) as cur:
+            return await cur.fetchone()
+
+async def aexec(sql:str, params:tuple=()) -> int:
+    """Run a single write statement (autocommitted) on a pooled connection; returns lastrowid."""
+    async with pool.connection() as conn:
+        cur = await conn.execute(sql, params)
+        return cur.lastrowid
+
+def _table_cols(conn:sqlite3.Connection, table:str) -> frozenset:
+    return frozenset(r["name"] for r in conn.execute(f"PRAGMA table_info({table})"))
+
 def col_exists(conn, table, col):
-    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
-    return any(r["name"] == col for r in rows)
+    return col in _table_cols(conn, table)
 
 def _ensure_schema():
     with db() as conn:
@@ -197,30 +306,48 @@ def _ensure_schema():
         if not col_exists(conn, "sent_msgs", "expires_at"):
             try: c.execute("ALTER TABLE sent_msgs ADD COLUMN expires_at TEXT")
             except: pass
+        # lookup indexes for the per-quiz / per-question / per-bundle filters
+        c.execute("CREATE INDEX IF NOT EXISTS idx_questions_quiz ON questions(quiz_id, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_questions_bundle ON questions(media_bundle_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_options_q ON options(question_id, option_index)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_qatt_q ON question_attachments(question_id, position)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mba_bundle ON media_bundle_attachments(bundle_id, position)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_bundles_quiz ON media_bundles(quiz_id, id DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_sent_chat_quiz ON sent_msgs(chat_id, quiz_id, id DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_responses_qu ON responses(question_id, user_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_responses_chat_q_user ON responses(chat_id, question_id, user_id, is_correct)")
+        # one progress row per (chat, user, quiz) so finishing can UPSERT; keep the oldest row of any legacy duplicates
+        if not c.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='uq_progress_chat_user_quiz'").fetchone():
+            c.execute("""DELETE FROM user_progress WHERE id NOT IN
+                         (SELECT MIN(id) FROM user_progress GROUP BY origin_chat_id, user_id, quiz_id)""")
+            c.execute("CREATE UNIQUE INDEX uq_progress_chat_user_quiz ON user_progress(origin_chat_id, user_id, quiz_id)")
         conn.commit()
 
 def migrate_legacy_media():
     with db() as conn:
-        cols = {r["name"] for r in conn.execute("PRAGMA table_info(questions)").fetchall()}
-        if not {'photo','audio','audio_is_voice'}.issubset(cols):
+        if not {'photo','audio','audio_is_voice'}.issubset(_table_cols(conn, "questions")):
             return
+        # write lock up front so the has_atts snapshot can't go stale before the insert
+        conn.execute("BEGIN IMMEDIATE")
         rows = conn.execute("""
             SELECT id, photo, audio, COALESCE(audio_is_voice,0) AS audio_is_voice
             FROM questions
             WHERE (photo IS NOT NULL OR audio IS NOT NULL)
         """).fetchall()
+        if not rows: return
+        has_atts = {r[0] for r in conn.execute("SELECT DISTINCT question_id FROM question_attachments")}
+        inserts = []
         for r in rows:
             qid = r["id"]
-            exists = conn.execute("SELECT 1 FROM question_attachments WHERE question_id=? LIMIT 1",(qid,)).fetchone()
-            if exists: continue
+            if qid in has_atts: continue
             pos = 0
             if r["photo"]:
-                conn.execute("INSERT INTO question_attachments(question_id, kind, file_id, position) VALUES (?,?,?,?)",
-                             (qid, "photo", r["photo"], pos)); pos += 1
+                inserts.append((qid, "photo", r["photo"], pos)); pos += 1
             if r["audio"]:
                 kind = "voice" if int(r["audio_is_voice"])==1 else "audio"
-                conn.execute("INSERT INTO question_attachments(question_id, kind, file_id, position) VALUES (?,?,?,?)",
-                             (qid, kind, r["audio"], pos))
+                inserts.append((qid, kind, r["audio"], pos))
+        if not inserts: return
+        conn.executemany(SQL_INS_QATT, inserts)
         conn.commit()
 
 _ensure_schema()
@@ -229,9 +356,19 @@ migrate_legacy_media()
 # ---------------------- Owner check ----------------------
 def is_owner(user_id: int) -> bool: return user_id == OWNER_ID
 async def ensure_owner(msg: Message) -> bool:
-    if not is_owner(msg.from_user.id):
-        await msg.reply("🚫 هذا الزر/الأمر خاص بالمالك.", reply_markup=owner_panel_reply_kb()); return False
-    return True
+    if msg.from_user and is_owner(msg.from_user.id): return True
+    await msg.reply("🚫 هذا الزر/الأمر خاص بالمالك.", reply_markup=OWNER_PANEL_KB); return False
+
+def owner_only(fn):
+    """Reject non-owners before the handler body touches FSM data or the DB."""
+    @wraps(fn)
+    async def wrapper(msg:Message, *args, **kwargs):
+        if not await ensure_owner(msg):
+            state = kwargs.get("state")
+            if state is not None: await state.clear()
+            return
+        return await fn(msg, *args, **kwargs)
+    return wrapper
 
 # ---------------------- UI Text ----------------------
 BTN_NEWQUIZ = "🆕 إنشاء اختبار"
@@ -266,16 +403,6 @@ BTN_DUR_CUSTOM = "⏱️ إدخال يدوي"
 BTN_DUR_NONE   = "♾️ بلا وقت"
 
 # ---------------------- States ----------------------
-@dataclass
-class BuildSession:
-    quiz_id: Optional[int] = None
-    tmp_question_id: Optional[int] = None
-    options_needed: int = 0
-    options_collected: int = 0
-    att_count: int = 0
-
-build_session = BuildSession()
-
 class BuildStates(StatesGroup):
     waiting_title = State()
     waiting_pick_quiz_for_addq = State()
@@ -316,16 +443,19 @@ class MergeStates(StatesGroup):
 class ExportStates(StatesGroup):
     waiting_pick_quiz = State()
 
-pending_names: Dict[Tuple[int,int,int], bool] = {}
+pending_names: Dict[Tuple[int,int], set] = {}  # (chat_id, user_id) -> quiz ids awaiting a name
 
 # ---------------------- Numbering helper (up to 10 options) ----------------------
-CIRCLED = ["①","②","③","④","⑤","⑥","⑦","⑧","⑨","⑩"]
+CIRCLED = ("①","②","③","④","⑤","⑥","⑦","⑧","⑨","⑩")
 def circ_num(idx: int) -> str:
-    return CIRCLED[idx] if 0 <= idx < len(CIRCLED) else f"{idx+1})"
+    # option_index is always >= 0, so only the >10 case falls through
+    try: return CIRCLED[idx]
+    except IndexError: return f"{idx+1})"
 
 # ---------------------- Keyboards ----------------------
-def owner_panel_reply_kb() -> ReplyKeyboardMarkup:
-    rows = [
+# constant keyboards are built once at import and reused by every reply
+OWNER_PANEL_KB = ReplyKeyboardMarkup(
+    keyboard=[
         [KeyboardButton(text=BTN_BACK_HOME), KeyboardButton(text=BTN_BACK_STEP)],
         [KeyboardButton(text=BTN_NEWQUIZ)],
         [KeyboardButton(text=BTN_ADDQ)],
@@ -339,105 +469,174 @@ def owner_panel_reply_kb() -> ReplyKeyboardMarkup:
         [KeyboardButton(text=BTN_PUBLISH)],
         [KeyboardButton(text=BTN_WIPE_ALL)],
         [KeyboardButton(text=BTN_SCORE)],
-    ]
-    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
-
-def attach_mode_kb() -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    kb.button(text=BTN_USE_BUNDLE, callback_data="attach_mode:bundle")
-    kb.button(text=BTN_USE_OWN, callback_data="attach_mode:own")
-    kb.button(text=BTN_USE_NONE, callback_data="attach_mode:none")
-    kb.adjust(1)
-    return kb.as_markup()
+    ],
+    resize_keyboard=True,
+)
 
-def paged_quizzes_kb(page: int = 0, tag: str = "pickq", per:int=8) -> InlineKeyboardMarkup:
-    with db() as conn:
-        rows = conn.execute("SELECT id,title FROM quizzes WHERE is_archived=0 ORDER BY id DESC").fetchall()
-    start = page * per; chunk = rows[start:start+per]
-    kb = InlineKeyboardBuilder()
-    for r in chunk:
-        kb.button(text=f"✅ ID {r['id']} — {r['title']}", callback_data=f"{tag}:{r['id']}")
-    kb.adjust(1); kb.row()
-    if start > 0: kb.button(text="⬅️", callback_data=f"{tag}_page:{page-1}")
-    kb.button(text=f"صفحة {page+1}", callback_data="noop")
-    if start + per < len(rows): kb.button(text="➡️", callback_data=f"{tag}_page:{page+1}")
-    return kb.as_markup()
-
-def paged_questions_kb(quiz_id:int, page:int=0, tag:str="manageq", per:int=10) -> InlineKeyboardMarkup:
-    with db() as conn:
-        rows = conn.execute("SELECT id, text FROM questions WHERE quiz_id=? ORDER BY id", (quiz_id,)).fetchall()
-    start = page * per; chunk = rows[start:start+per]
-    kb = InlineKeyboardBuilder()
+ATTACH_MODE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=BTN_USE_BUNDLE, callback_data="attach_mode:bundle")],
+    [InlineKeyboardButton(text=BTN_USE_OWN, callback_data="attach_mode:own")],
+    [InlineKeyboardButton(text=BTN_USE_NONE, callback_data="attach_mode:none")],
+])
+
+PUBLISH_DURATION_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=BTN_DUR_12H, callback_data="dur:12"),
+     InlineKeyboardButton(text=BTN_DUR_24H, callback_data="dur:24")],
+    [InlineKeyboardButton(text=BTN_DUR_CUSTOM, callback_data="dur:custom"),
+     InlineKeyboardButton(text=BTN_DUR_NONE, callback_data="dur:none")],
+])
+
+WIPE_CONFIRM_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ نعم", callback_data="yes:wipe"),
+     InlineKeyboardButton(text="❌ لا", callback_data="no:wipe")],
+])
+
+# paged keyboards keyed on (builder, args); any write to quizzes/questions/bundles clears them.
+# _kb_version guards against a build that raced a write storing a stale page.
+KB_CACHE_SIZE = 256
+_kb_cache: "OrderedDict[tuple, InlineKeyboardMarkup]" = OrderedDict()
+_kb_version = 0
+
+def invalidate_kb_cache():
+    global _kb_version
+    _kb_version += 1; _kb_cache.clear()
+
+def _cached_kb(fn):
+    sig = inspect.signature(fn)
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        # normalise positional/keyword/default spellings of the same call to one key
+        bound = sig.bind(*args, **kwargs); bound.apply_defaults()
+        key = (fn.__name__, tuple(bound.arguments.values()))
+        kb = _kb_cache.get(key)
+        if kb is not None:
+            _kb_cache.move_to_end(key); return kb
+        version = _kb_version
+        kb = await fn(*args, **kwargs)
+        if version == _kb_version:
+            _kb_cache[key] = kb
+            if len(_kb_cache) > KB_CACHE_SIZE: _kb_cache.popitem(last=False)
+        return kb
+    return wrapper
+
+@_cached_kb
+async def paged_quizzes_kb(page: int = 0, tag: str = "pickq", per:int=8) -> InlineKeyboardMarkup:
+    start = page * per
+    rows = await fetch_rows("SELECT id,title FROM quizzes WHERE is_archived=0 ORDER BY id DESC LIMIT ? OFFSET ?", (per + 1, start))
+    has_next = len(rows) > per; chunk = rows[:per]
+    kb = [[InlineKeyboardButton(text=f"✅ ID {r['id']} — {r['title']}", callback_data=f"{tag}:{r['id']}")] for r in chunk]
+    nav = []
+    if start > 0: nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"{tag}_page:{page-1}"))
+    nav.append(InlineKeyboardButton(text=f"صفحة {page+1}", callback_data="noop"))
+    if has_next: nav.append(InlineKeyboardButton(text="➡️", callback_data=f"{tag}_page:{page+1}"))
+    kb.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+@_cached_kb
+async def paged_questions_kb(quiz_id:int, page:int=0, tag:str="manageq", per:int=10) -> InlineKeyboardMarkup:
+    start = page * per
+    rows = await fetch_rows("SELECT id, text FROM questions WHERE quiz_id=? ORDER BY id LIMIT ? OFFSET ?", (quiz_id, per + 1, start))
+    has_next = len(rows) > per; chunk = rows[:per]
+    kb = []
     for r in chunk:
         label = r['text']
         if len(label) > 40: label = label[:40] + "…"
-        kb.button(text=f"🔹 Q{r['id']} — {label}", callback_data=f"{tag}:{quiz_id}:{r['id']}:{page}")
-    kb.adjust(1); kb.row()
-    if start > 0: kb.button(text="⬅️", callback_data=f"{tag}_page:{quiz_id}:{page-1}")
-    kb.button(text=f"صفحة {page+1}", callback_data="noop")
-    if start + per < len(rows): kb.button(text="➡️", callback_data=f"{tag}_page:{quiz_id}:{page+1}")
-    return kb.as_markup()
-
-def paged_bundles_kb(quiz_id:int, page:int=0, tag:str="pickbundle", per:int=8) -> InlineKeyboardMarkup:
-    with db() as conn:
-        rows = conn.execute("SELECT id FROM media_bundles WHERE quiz_id=? ORDER BY id DESC", (quiz_id,)).fetchall()
-    start = page * per; chunk = rows[start:start+per]
-    kb = InlineKeyboardBuilder()
-    for r in chunk:
-        with db() as c2:
-            att_cnt = c2.execute("SELECT COUNT(*) FROM media_bundle_attachments WHERE bundle_id=?", (r["id"],)).fetchone()[0]
-            q_cnt = c2.execute("SELECT COUNT(*) FROM questions WHERE media_bundle_id=?", (r["id"],)).fetchone()[0]
-        kb.button(text=f"📎 حزمة {r['id']} — ملفات:{att_cnt} / أسئلة:{q_cnt}", callback_data=f"{tag}:{quiz_id}:{r['id']}")
-    kb.adjust(1); kb.row()
-    if start > 0: kb.button(text="⬅️", callback_data=f"{tag}_page:{quiz_id}:{page-1}")
-    kb.button(text=f"صفحة {page+1}", callback_data="noop")
-    if start + per < len(rows): kb.button(text="➡️", callback_data=f"{tag}_page:{quiz_id}:{page+1}")
-    return kb.as_markup()
-
-def publish_duration_kb() -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    kb.button(text=BTN_DUR_12H, callback_data="dur:12")
-    kb.button(text=BTN_DUR_24H, callback_data="dur:24")
-    kb.button(text=BTN_DUR_CUSTOM, callback_data="dur:custom")
-    kb.button(text=BTN_DUR_NONE, callback_data="dur:none")
-    kb.adjust(2)
-    return kb.as_markup()
+        kb.append([InlineKeyboardButton(text=f"🔹 Q{r['id']} — {label}", callback_data=f"{tag}:{quiz_id}:{r['id']}:{page}")])
+    nav = []
+    if start > 0: nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"{tag}_page:{quiz_id}:{page-1}"))
+    nav.append(InlineKeyboardButton(text=f"صفحة {page+1}", callback_data="noop"))
+    if has_next: nav.append(InlineKeyboardButton(text="➡️", callback_data=f"{tag}_page:{quiz_id}:{page+1}"))
+    kb.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+@_cached_kb
+async def paged_bundles_kb(quiz_id:int, page:int=0, tag:str="pickbundle", per:int=8) -> InlineKeyboardMarkup:
+    start = page * per
+    rows = await fetch_rows("""
+        SELECT b.id,
+               (SELECT COUNT(*) FROM media_bundle_attachments WHERE bundle_id=b.id) AS att_cnt,
+               (SELECT COUNT(*) FROM questions WHERE media_bundle_id=b.id) AS q_cnt
+        FROM media_bundles b WHERE b.quiz_id=? ORDER BY b.id DESC LIMIT ? OFFSET ?
+    """, (quiz_id, per + 1, start))
+    has_next = len(rows) > per; chunk = rows[:per]
+    kb = [[InlineKeyboardButton(text=f"📎 حزمة {r['id']} — ملفات:{r['att_cnt']} / أسئلة:{r['q_cnt']}",
+                                callback_data=f"{tag}:{quiz_id}:{r['id']}")] for r in chunk]
+    nav = []
+    if start > 0: nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"{tag}_page:{quiz_id}:{page-1}"))
+    nav.append(InlineKeyboardButton(text=f"صفحة {page+1}", callback_data="noop"))
+    if has_next: nav.append(InlineKeyboardButton(text="➡️", callback_data=f"{tag}_page:{quiz_id}:{page+1}"))
+    kb.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=kb)
 
 # ---------------------- Helpers ----------------------
-def get_quiz_question_ids(quiz_id: int) -> List[int]:
-    with db() as conn:
-        rows = conn.execute("SELECT id FROM questions WHERE quiz_id=? ORDER BY id", (quiz_id,)).fetchall()
-    return [r["id"] for r in rows]
-
-def options_for_question(question_id:int) -> List[sqlite3.Row]:
-    with db() as conn:
-        rows = conn.execute("SELECT option_index, text, is_correct FROM options WHERE question_id=? ORDER BY option_index", (question_id,)).fetchall()
+# quiz_id -> (question ids, same ids as a JSON array for json_each); dropped whenever a quiz's question set changes
+_qids_cache: Dict[int, Tuple[Tuple[int, ...], str]] = {}
+
+def invalidate_qids_cache(quiz_id:Optional[int] = None):
+    if quiz_id is None: _qids_cache.clear()
+    else: _qids_cache.pop(quiz_id, None)
+
+async def get_quiz_question_ids(quiz_id:int, conn:Optional[aiosqlite.Connection] = None) -> Tuple[Tuple[int, ...], str]:
+    hit = _qids_cache.get(quiz_id)
+    if hit is not None: return hit
+    sql = "SELECT id FROM questions WHERE quiz_id=? ORDER BY id"
+    rows = await conn.execute_fetchall(sql, (quiz_id,)) if conn else await fetch_rows(sql, (quiz_id,))
+    q_ids = tuple(r["id"] for r in rows)
+    hit = _qids_cache[quiz_id] = (q_ids, orjson.dumps(q_ids).decode())
+    return hit
+
+# per-question LRU of options and rendered cards; dropped on any option/question write
+QCACHE_SIZE = 1024
+_opts_cache: "OrderedDict[int, List[sqlite3.Row]]" = OrderedDict()
+_card_cache: "OrderedDict[int, Tuple[str, str]]" = OrderedDict()
+
+def _lru_put(cache:OrderedDict, key, value):
+    cache[key] = value; cache.move_to_end(key)
+    if len(cache) > QCACHE_SIZE: cache.popitem(last=False)
+
+def invalidate_question_cache(question_id:Optional[int] = None):
+    if question_id is None:
+        _opts_cache.clear(); _card_cache.clear(); return
+    _opts_cache.pop(question_id, None); _card_cache.pop(question_id, None)
+
+async def options_for_question(question_id:int) -> List[sqlite3.Row]:
+    rows = _opts_cache.get(question_id)
+    if rows is not None:
+        _opts_cache.move_to_end(question_id); return rows
+    rows = await fetch_rows("SELECT option_index, text, is_correct FROM options WHERE question_id=? ORDER BY option_index", (question_id,))
+    _lru_put(_opts_cache, question_id, rows)
     return rows
 
-def build_options_kb(question_id:int, target_user_id:int) -> InlineKeyboardMarkup:
-    rows = options_for_question(question_id)
-    kb = InlineKeyboardBuilder()
+def build_options_kb_from(rows:List[sqlite3.Row], question_id:int, target_user_id:int) -> InlineKeyboardMarkup:
+    kb = []
     for r in rows:
         idx = int(r['option_index']); text = r['text']; circ = circ_num(idx)
-        kb.button(text=f"{circ} {text}", callback_data=f"ans:{question_id}:{idx}:{target_user_id}")
-    kb.adjust(1)
-    return kb.as_markup()
-
-def get_question_atts(question_id:int) -> List[sqlite3.Row]:
-    with db() as conn:
-        rows = conn.execute("SELECT kind, file_id, position FROM question_attachments WHERE question_id=? ORDER BY position",(question_id,)).fetchall()
-    return rows
-
-def get_bundle_atts(bundle_id:int) -> List[sqlite3.Row]:
-    with db() as conn:
-        rows = conn.execute(
-            "SELECT kind, file_id, position FROM media_bundle_attachments WHERE bundle_id=? ORDER BY position",
-            (bundle_id,)  # tuple!
-        ).fetchall()
-    return rows
+        kb.append([InlineKeyboardButton(text=f"{circ} {text}", callback_data=f"ans:{question_id}:{idx}:{target_user_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def extract_media(msg:Message) -> Optional[Tuple[str, str]]:
+    if msg.photo: return "photo", msg.photo[-1].file_id
+    if msg.voice: return "voice", msg.voice.file_id
+    if msg.audio: return "audio", msg.audio.file_id
+    return None
+
+MEDIA_GROUP_TYPES = {"photo": InputMediaPhoto, "audio": InputMediaAudio}
+
+def media_runs(atts:List[sqlite3.Row]) -> List[List[sqlite3.Row]]:
+    """Split attachments (position order) into send runs: consecutive photos (or audios)
+    form one sendMediaGroup album (up to 10); voices are not groupable and go one by one."""
+    runs: List[List[sqlite3.Row]] = []
+    for a in atts:
+        if a["kind"] in MEDIA_GROUP_TYPES and runs and runs[-1][0]["kind"] == a["kind"] and len(runs[-1]) < 10:
+            runs[-1].append(a)
+        else:
+            runs.append([a])
+    return runs
 
-def question_card_text(qrow:sqlite3.Row) -> str:
-    opts = options_for_question(qrow["id"])
+async def question_card_text(qrow:sqlite3.Row) -> str:
+    hit = _card_cache.get(qrow["id"])
+    if hit and hit[0] == qrow["text"]: return hit[1]
+    opts = await options_for_question(qrow["id"])
     lines = [f"Q{qrow['id']}: <b>{qrow['text']}</b>"]
     if opts:
         lines.append("الخيارات:")
@@ -447,23 +646,50 @@ def question_card_text(qrow:sqlite3.Row) -> str:
             lines.append(f"{circ} {r['text']}{mark}")
     else:
         lines.append("— لا يوجد خيارات —")
-    return "\n".join(lines)
+    card = "\n".join(lines)
+    _lru_put(_card_cache, qrow["id"], (qrow["text"], card))
+    return card
+
+_HTML_TR = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
 
 def hlink_user(name:str, user_id:int) -> str:
-    safe = name.replace("<","&lt;").replace(">","&gt;")
+    safe = name.translate(_HTML_TR)
     return f'<a href="tg://user?id={user_id}">{safe}</a>'
 
-def _now_utc() -> datetime: return datetime.now(timezone.utc)
+# row timestamps only need second resolution: reformat at most once a second
+_NOW_CACHE = {"t": 0.0, "s": ""}
 
-def _quiz_expired(chat_id:int, quiz_id:int) -> Optional[bool]:
-    with db() as conn:
-        row = conn.execute("""SELECT expires_at FROM sent_msgs
-                              WHERE chat_id=? AND quiz_id=? AND expires_at IS NOT NULL
-                              ORDER BY id DESC LIMIT 1""", (chat_id, quiz_id)).fetchone()
-    if not row or not row["expires_at"]: return None
-    try: exp = datetime.fromisoformat(row["expires_at"])
+def now_iso() -> str:
+    t = time.time()
+    if t - _NOW_CACHE["t"] >= 1.0:
+        _NOW_CACHE["t"] = t; _NOW_CACHE["s"] = datetime.fromtimestamp(t, tz=timezone.utc).isoformat()
+    return _NOW_CACHE["s"]
+
+# (chat_id, quiz_id) -> latest publish deadline as epoch seconds (None = no limit); filled at publish or on first lookup
+EXPIRY_CACHE: Dict[Tuple[int,int], Optional[float]] = {}
+
+def _parse_expiry(value:Optional[str]) -> Optional[float]:
+    if not value: return None
+    try: dt = datetime.fromisoformat(value)
     except: return None
-    return _now_utc() > exp
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)  # deadlines are written in UTC
+    return dt.timestamp()
+
+async def _quiz_expired(chat_id:int, quiz_id:int, conn=None) -> Optional[bool]:
+    """conn: reuse the caller's pooled connection on a cache miss instead of taking a second one."""
+    key = (chat_id, quiz_id)
+    if key not in EXPIRY_CACHE:
+        if conn is None:
+            async with pool.connection() as conn:
+                return await _quiz_expired(chat_id, quiz_id, conn)
+        async with conn.execute("""SELECT expires_at FROM sent_msgs
+                                   WHERE chat_id=? AND quiz_id=? AND expires_at IS NOT NULL
+                                   ORDER BY id DESC LIMIT 1""", (chat_id, quiz_id)) as cur:
+            row = await cur.fetchone()
+        EXPIRY_CACHE[key] = _parse_expiry(row["expires_at"] if row else None)
+    exp = EXPIRY_CACHE[key]
+    if exp is None: return None
+    return time.time() > exp
 
 # ---------------------- Bulk import helpers ----------------------
 def parse_attachments_field(field: str) -> List[Tuple[str,str]]:
@@ -480,147 +706,162 @@ def parse_attachments_field(field: str) -> List[Tuple[str,str]]:
             out.append((kind, fid))
     return out[:5]
 
-def parse_bulk_csv(text: str) -> List[dict]:
-    sio = StringIO(text)
-    reader = csv.DictReader(sio)
-    rows = []
-    ln = 1
-    for row in reader:
-        ln += 1
-        q = (row.get("question") or "").strip()
-        opts_raw = (row.get("options") or "").strip()
-        correct_raw = (row.get("correct") or "").strip()
-        atts_raw = (row.get("attachments") or "").strip()
+CSV_FIELDS = ("question", "options", "correct", "attachments")
+
+def split_bulk_csv(text: str) -> Tuple[List[Optional[int]], List[Tuple[int, List[str]]]]:
+    """(column position of each CSV_FIELDS entry, [(line number, raw row)]); blank rows dropped."""
+    # plain csv.reader rows + header positions resolved once: no per-row dict like DictReader
+    reader = csv.reader(StringIO(text))
+    header = next(reader, None)
+    if header is None: return [], []
+    cols = {name: i for i, name in enumerate(header)}
+    rows = [row for row in reader if row]
+    return [cols.get(f) for f in CSV_FIELDS], list(enumerate(rows, start=2))
+
+def validate_bulk_rows(idx: List[Optional[int]], rows: List[Tuple[int, List[str]]]) -> List[dict]:
+    out: List[dict] = []
+    for ln, row in rows:
+        q, opts_raw, correct_raw, atts_raw = (row[i].strip() if i is not None and i < len(row) else "" for i in idx)
         if not q or not opts_raw or not correct_raw:
-            rows.append({"_error": f"سطر {ln}: حقول ناقصة (question/options/correct)."}); continue
+            out.append({"_error": f"سطر {ln}: حقول ناقصة (question/options/correct)."}); continue
         options = [o.strip() for o in opts_raw.split("|") if o.strip()]
         if not (2 <= len(options) <= 10):
-            rows.append({"_error": f"سطر {ln}: عدد الخيارات {len(options)} (المسموح 2..10)."}); continue
+            out.append({"_error": f"سطر {ln}: عدد الخيارات {len(options)} (المسموح 2..10)."}); continue
         try: correct = int(correct_raw)
-        except: rows.append({"_error": f"سطر {ln}: قيمة correct ليست رقم."}); continue
+        except: out.append({"_error": f"سطر {ln}: قيمة correct ليست رقم."}); continue
         if not (1 <= correct <= len(options)):
-            rows.append({"_error": f"سطر {ln}: correct خارج النطاق (1..{len(options)})."}); continue
+            out.append({"_error": f"سطر {ln}: correct خارج النطاق (1..{len(options)})."}); continue
         attachments = parse_attachments_field(atts_raw)
-        rows.append({"question": q, "options": options, "correct_index0": correct - 1, "attachments": attachments})
-    return rows
+        out.append({"question": q, "options": options, "correct_index0": correct - 1, "attachments": attachments})
+    return out
 
-def insert_question_with_data(quiz_id:int, q_text:str, options:List[str], correct_index0:int, attachments:List[Tuple[str,str]]) -> int:
-    with db() as conn:
-        cur = conn.execute("INSERT INTO questions(quiz_id, text, created_at) VALUES (?,?,?)",
-                           (quiz_id, q_text, datetime.now(timezone.utc).isoformat()))
-        qid = cur.lastrowid
-        for i, opt_text in enumerate(options):
-            conn.execute("INSERT INTO options(question_id, option_index, text, is_correct) VALUES (?,?,?,?)",
-                         (qid, i, opt_text, 1 if i == correct_index0 else 0))
-        for pos, (kind, fid) in enumerate(attachments[:5]):
-            conn.execute("INSERT INTO question_attachments(question_id, kind, file_id, position) VALUES (?,?,?,?)",
-                         (qid, kind, fid, pos))
-        conn.commit()
-        return qid
+def question_child_rows(qid:int, options:List[str], correct_index0:int, attachments:List[Tuple[str,str]]) -> Tuple[List[tuple], List[tuple]]:
+    """Parameter rows for SQL_INS_OPT / SQL_INS_QATT of one question."""
+    return ([(qid, i, t, 1 if i == correct_index0 else 0) for i, t in enumerate(options)],
+            [(qid, kind, fid, pos) for pos, (kind, fid) in enumerate(attachments[:5])])
 
 # ---------------------- Merge helpers ----------------------
-def _copy_bundle(quiz_dst:int, bundle_id:int, bundle_map:Dict[int,int]) -> int:
+@dataclass
+class CopyBatch:
+    """Child rows gathered while copying questions; flushed with executemany once."""
+    ts: str
+    options: List[tuple] = field(default_factory=list)
+    attachments: List[tuple] = field(default_factory=list)
+    bundle_attachments: List[tuple] = field(default_factory=list)
+
+def _group_rows(rows, key:str) -> Dict[int, List[sqlite3.Row]]:
+    out: Dict[int, List[sqlite3.Row]] = defaultdict(list)
+    for r in rows: out[r[key]].append(r)
+    return out
+
+async def _copy_bundle(conn, quiz_dst:int, bundle_id:int, bundle_map:Dict[int,int],
+                       batts_by_b:Dict[int, List[sqlite3.Row]], batch:CopyBatch) -> int:
     """Copy a media bundle to quiz_dst; return new bundle id; memoized in bundle_map."""
     if bundle_id in bundle_map: return bundle_map[bundle_id]
-    with db() as conn:
-        cur = conn.execute("INSERT INTO media_bundles(quiz_id, created_at) VALUES (?,?)",
-                           (quiz_dst, datetime.now(timezone.utc).isoformat()))
-        new_b = cur.lastrowid
-        atts = conn.execute("SELECT kind, file_id, position FROM media_bundle_attachments WHERE bundle_id=? ORDER BY position",
-                            (bundle_id,)).fetchall()
-        for a in atts:
-            conn.execute("INSERT INTO media_bundle_attachments(bundle_id, kind, file_id, position) VALUES (?,?,?,?)",
-                         (new_b, a["kind"], a["file_id"], a["position"]))
-        conn.commit()
+    cur = await conn.execute("INSERT INTO media_bundles(quiz_id, created_at) VALUES (?,?)", (quiz_dst, batch.ts))
+    new_b = cur.lastrowid
+    batch.bundle_attachments.extend((new_b, a["kind"], a["file_id"], a["position"]) for a in batts_by_b.get(bundle_id, ()))
     bundle_map[bundle_id] = new_b
     return new_b
 
-def _copy_question_to_quiz(qrow:sqlite3.Row, quiz_dst:int, bundle_map:Dict[int,int]) -> int:
+async def _copy_question_to_quiz(conn, qrow:sqlite3.Row, quiz_dst:int, bundle_map:Dict[int,int],
+                                 opts_by_q, atts_by_q, batts_by_b, batch:CopyBatch) -> int:
     """Deep copy a question (text, options, own attachments, bundle link) into quiz_dst."""
-    with db() as conn:
-        new_bundle_id = None
-        if qrow["media_bundle_id"]:
-            new_bundle_id = _copy_bundle(quiz_dst, int(qrow["media_bundle_id"]), bundle_map)
-        cur = conn.execute("INSERT INTO questions(quiz_id, text, created_at, media_bundle_id) VALUES (?,?,?,?)",
-                           (quiz_dst, qrow["text"], datetime.now(timezone.utc).isoformat(), new_bundle_id))
-        new_qid = cur.lastrowid
-        # options
-        opts = conn.execute("SELECT option_index, text, is_correct FROM options WHERE question_id=? ORDER BY option_index",
-                            (qrow["id"],)).fetchall()
-        for o in opts:
-            conn.execute("INSERT INTO options(question_id, option_index, text, is_correct) VALUES (?,?,?,?)",
-                         (new_qid, o["option_index"], o["text"], o["is_correct"]))
-        # attachments
-        atts = conn.execute("SELECT kind, file_id, position FROM question_attachments WHERE question_id=? ORDER BY position",
-                            (qrow["id"],)).fetchall()
-        for a in atts:
-            conn.execute("INSERT INTO question_attachments(question_id, kind, file_id, position) VALUES (?,?,?,?)",
-                         (new_qid, a["kind"], a["file_id"], a["position"]))
-        conn.commit()
-        return new_qid
-
-def merge_quizzes_create_new(src_id:int, dst_id:int) -> int:
+    new_bundle_id = None
+    if qrow["media_bundle_id"]:
+        new_bundle_id = await _copy_bundle(conn, quiz_dst, int(qrow["media_bundle_id"]), bundle_map, batts_by_b, batch)
+    cur = await conn.execute("INSERT INTO questions(quiz_id, text, created_at, media_bundle_id) VALUES (?,?,?,?)",
+                             (quiz_dst, qrow["text"], batch.ts, new_bundle_id))
+    new_qid = cur.lastrowid
+    batch.options.extend((new_qid, o["option_index"], o["text"], o["is_correct"]) for o in opts_by_q.get(qrow["id"], ()))
+    batch.attachments.extend((new_qid, a["kind"], a["file_id"], a["position"]) for a in atts_by_q.get(qrow["id"], ()))
+    return new_qid
+
+async def merge_quizzes_create_new(src_id:int, dst_id:int) -> int:
     """Create a NEW quiz that contains questions of src_id then dst_id (order preserved by original IDs)."""
-    with db() as conn:
-        src = conn.execute("SELECT * FROM quizzes WHERE id=?", (src_id,)).fetchone()
-        dst = conn.execute("SELECT * FROM quizzes WHERE id=?", (dst_id,)).fetchone()
+    batch = CopyBatch(ts=now_iso())
+    bundle_map: Dict[int,int] = {}
+    async with pool.connection() as conn:
+        async with conn.execute("SELECT * FROM quizzes WHERE id=?", (src_id,)) as cur:
+            src = await cur.fetchone()
+        async with conn.execute("SELECT * FROM quizzes WHERE id=?", (dst_id,)) as cur:
+            dst = await cur.fetchone()
         title = f"دمج: {src['title']} + {dst['title']}"
-        cur = conn.execute("INSERT INTO quizzes(title, created_by, created_at) VALUES (?,?,?)",
-                           (title, OWNER_ID, datetime.now(timezone.utc).isoformat()))
+        await conn.execute("BEGIN")
+        cur = await conn.execute("INSERT INTO quizzes(title, created_by, created_at) VALUES (?,?,?)",
+                                 (title, OWNER_ID, batch.ts))
         new_quiz_id = cur.lastrowid
-        conn.commit()
-
-    bundle_map: Dict[int,int] = {}
-    # copy src questions then dst questions
-    for qz in (src_id, dst_id):
-        with db() as conn:
-            questions = conn.execute("SELECT * FROM questions WHERE quiz_id=? ORDER BY id", (qz,)).fetchall()
-        for q in questions:
-            _copy_question_to_quiz(q, new_quiz_id, bundle_map)
-
+        # copy src questions then dst questions
+        for qz in (src_id, dst_id):
+            questions = await conn.execute_fetchall("SELECT * FROM questions WHERE quiz_id=? ORDER BY id", (qz,))
+            opts_by_q = _group_rows(await conn.execute_fetchall(
+                """SELECT question_id, option_index, text, is_correct FROM options
+                   WHERE question_id IN (SELECT id FROM questions WHERE quiz_id=?)
+                   ORDER BY question_id, option_index""", (qz,)), "question_id")
+            atts_by_q = _group_rows(await conn.execute_fetchall(
+                """SELECT question_id, kind, file_id, position FROM question_attachments
+                   WHERE question_id IN (SELECT id FROM questions WHERE quiz_id=?)
+                   ORDER BY question_id, position""", (qz,)), "question_id")
+            batts_by_b = _group_rows(await conn.execute_fetchall(
+                """SELECT bundle_id, kind, file_id, position FROM media_bundle_attachments
+                   WHERE bundle_id IN (SELECT media_bundle_id FROM questions WHERE quiz_id=?)
+                   ORDER BY bundle_id, position""", (qz,)), "bundle_id")
+            for q in questions:
+                await _copy_question_to_quiz(conn, q, new_quiz_id, bundle_map, opts_by_q, atts_by_q, batts_by_b, batch)
+        await conn.executemany(SQL_INS_OPT, batch.options)
+        await conn.executemany(SQL_INS_QATT, batch.attachments)
+        await conn.executemany(SQL_INS_BATT, batch.bundle_attachments)
+        await conn.commit()
+    invalidate_qids_cache(new_quiz_id); invalidate_kb_cache()
     return new_quiz_id
 
 # ---------------------- Export helpers ----------------------
-def export_quiz_json(quiz_id:int) -> dict:
-    with db() as conn:
-        quiz = conn.execute("SELECT * FROM quizzes WHERE id=?", (quiz_id,)).fetchone()
-        questions = conn.execute("SELECT * FROM questions WHERE quiz_id=? ORDER BY id", (quiz_id,)).fetchall()
-        # collect bundle ids used
-        bundle_ids = sorted({int(q["media_bundle_id"]) for q in questions if q["media_bundle_id"] is not None})
-        bundles = []
-        for bid in bundle_ids:
-            atts = conn.execute("SELECT kind, file_id, position FROM media_bundle_attachments WHERE bundle_id=? ORDER BY position",
-                                (bid,)).fetchall()
-            bundles.append({
-                "id": bid,
-                "attachments": [{"kind": a["kind"], "file_id": a["file_id"], "position": a["position"]} for a in atts]
-            })
-        qs_out = []
-        for q in questions:
-            opts = conn.execute("SELECT option_index, text, is_correct FROM options WHERE question_id=? ORDER BY option_index",
-                                (q["id"],)).fetchall()
-            atts = conn.execute("SELECT kind, file_id, position FROM question_attachments WHERE question_id=? ORDER BY position",
-                                (q["id"],)).fetchall()
-            qs_out.append({
-                "id": q["id"],
-                "text": q["text"],
-                "created_at": q["created_at"],
-                "media_bundle_id": q["media_bundle_id"],
-                "options": [{"option_index": o["option_index"], "text": o["text"], "is_correct": int(o["is_correct"])} for o in opts],
-                "attachments": [{"kind": a["kind"], "file_id": a["file_id"], "position": a["position"]} for a in atts]
-            })
-        return {
-            "exported_at": datetime.now(timezone.utc).isoformat(),
-            "quiz": {"id": quiz["id"], "title": quiz["title"], "created_by": quiz["created_by"], "created_at": quiz["created_at"]},
-            "media_bundles": bundles,
-            "questions": qs_out
-        }
+async def export_quiz_json(quiz_id:int) -> dict:
+    async with pool.connection() as conn:
+        async with conn.execute("SELECT * FROM quizzes WHERE id=?", (quiz_id,)) as cur:
+            quiz = await cur.fetchone()
+        questions = await conn.execute_fetchall("SELECT * FROM questions WHERE quiz_id=? ORDER BY id", (quiz_id,))
+        opts_by_q = _group_rows(await conn.execute_fetchall(
+            """SELECT question_id, option_index, text, is_correct FROM options
+               WHERE question_id IN (SELECT id FROM questions WHERE quiz_id=?)
+               ORDER BY question_id, option_index""", (quiz_id,)), "question_id")
+        atts_by_q = _group_rows(await conn.execute_fetchall(
+            """SELECT question_id, kind, file_id, position FROM question_attachments
+               WHERE question_id IN (SELECT id FROM questions WHERE quiz_id=?)
+               ORDER BY question_id, position""", (quiz_id,)), "question_id")
+        batts_by_b = _group_rows(await conn.execute_fetchall(
+            """SELECT bundle_id, kind, file_id, position FROM media_bundle_attachments
+               WHERE bundle_id IN (SELECT media_bundle_id FROM questions WHERE quiz_id=?)
+               ORDER BY bundle_id, position""", (quiz_id,)), "bundle_id")
+    # collect bundle ids used
+    bundle_ids = sorted({int(q["media_bundle_id"]) for q in questions if q["media_bundle_id"] is not None})
+    bundles = [{
+        "id": bid,
+        "attachments": [{"kind": a["kind"], "file_id": a["file_id"], "position": a["position"]} for a in batts_by_b.get(bid, ())]
+    } for bid in bundle_ids]
+    qs_out = [{
+        "id": q["id"],
+        "text": q["text"],
+        "created_at": q["created_at"],
+        "media_bundle_id": q["media_bundle_id"],
+        "options": [{"option_index": o["option_index"], "text": o["text"], "is_correct": int(o["is_correct"])} for o in opts_by_q.get(q["id"], ())],
+        "attachments": [{"kind": a["kind"], "file_id": a["file_id"], "position": a["position"]} for a in atts_by_q.get(q["id"], ())]
+    } for q in questions]
+    return {
+        "exported_at": datetime.now(timezone.utc).isoformat(),
+        "quiz": {"id": quiz["id"], "title": quiz["title"], "created_by": quiz["created_by"], "created_at": quiz["created_at"]},
+        "media_bundles": bundles,
+        "questions": qs_out
+    }
+
+async def export_quiz_json_bytes(quiz_id:int) -> bytes:
+    return orjson.dumps(await export_quiz_json(quiz_id), option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
 
 # ---------------------- Start & ReplyKeyboard ----------------------
 @dp.message(Command("start"))
 async def cmd_start(msg: Message):
     if is_owner(msg.from_user.id):
-        await msg.answer("لوحة التحكم جاهزة — اختر من الأزرار:", reply_markup=owner_panel_reply_kb())
+        await msg.answer("لوحة التحكم جاهزة — اختر من الأزرار:", reply_markup=OWNER_PANEL_KB)
     else:
         await msg.answer("أهلاً! هذا بوت اختبارات بإدارة المعلم.\nالإجابات تظهر كمنبثقات داخل المجموعة مع خصوصية كاملة.")
 
@@ -628,190 +869,179 @@ async def cmd_start(msg: Message):
 @dp.message(F.text == BTN_BACK_HOME)
 async def btn_back_home(msg:Message, state:FSMContext):
     await state.clear()
-    await msg.answer("تم الرجوع للبداية.", reply_markup=owner_panel_reply_kb())
+    await msg.answer("تم الرجوع للبداية.", reply_markup=OWNER_PANEL_KB)
 
 @dp.message(F.text == BTN_BACK_STEP)
 async def btn_back_step(msg:Message, state:FSMContext):
     _ = await state.get_state()
     await state.clear()
-    await msg.answer("رجعناك للبداية.", reply_markup=owner_panel_reply_kb())
+    await msg.answer("رجعناك للبداية.", reply_markup=OWNER_PANEL_KB)
 
 # ---------------------- Buttons ----------------------
 @dp.message(F.text == BTN_NEWQUIZ)
+@owner_only
 async def btn_newquiz(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): return
     await state.set_state(BuildStates.waiting_title)
-    await msg.answer("🆕 أرسل عنوان/اسم الاختبار:", reply_markup=owner_panel_reply_kb())
+    await msg.answer("🆕 أرسل عنوان/اسم الاختبار:", reply_markup=OWNER_PANEL_KB)
 
 @dp.message(F.text == BTN_ADDQ)
+@owner_only
 async def btn_addq(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): return
     await state.set_state(BuildStates.waiting_pick_quiz_for_addq)
-    await msg.answer("اختر الاختبار لإضافة سؤال:", reply_markup=paged_quizzes_kb(0,"pick_for_addq"))
+    await msg.answer("اختر الاختبار لإضافة سؤال:", reply_markup=await paged_quizzes_kb(0,"pick_for_addq"))
 
 @dp.message(F.text == BTN_LISTQUIZ)
+@owner_only
 async def btn_list_quizzes(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): return
-    await msg.answer("📚 اختر اختبار للاطلاع على تفاصيله:", reply_markup=paged_quizzes_kb(0,"overview_q"))
+    await msg.answer("📚 اختر اختبار للاطلاع على تفاصيله:", reply_markup=await paged_quizzes_kb(0,"overview_q"))
 
 @dp.message(F.text == BTN_LISTQ)
+@owner_only
 async def btn_list_questions(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): return
     await state.set_state(BuildStates.waiting_pick_quiz_generic)
-    await msg.answer("اختر الاختبار لعرض أسئلته:", reply_markup=paged_quizzes_kb(0,"listq_pickq"))
+    await msg.answer("اختر الاختبار لعرض أسئلته:", reply_markup=await paged_quizzes_kb(0,"listq_pickq"))
 
 @dp.message(F.text == BTN_EDITQUIZ)
+@owner_only
 async def btn_edit_quiz(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): return
     await state.set_state(BuildStates.waiting_edit_quiz_title)
-    await msg.answer("اختر اختبار لتعديل عنوانه:", reply_markup=paged_quizzes_kb(0,"renameq"))
+    await msg.answer("اختر اختبار لتعديل عنوانه:", reply_markup=await paged_quizzes_kb(0,"renameq"))
 
 @dp.message(F.text == BTN_DELQUIZ)
+@owner_only
 async def btn_del_quiz(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): return
     await state.set_state(BuildStates.waiting_pick_quiz_generic)
-    await msg.answer("اختر اختبارًا لحذفه:", reply_markup=paged_quizzes_kb(0,"delqz"))
+    await msg.answer("اختر اختبارًا لحذفه:", reply_markup=await paged_quizzes_kb(0,"delqz"))
 
 @dp.message(F.text == BTN_BUNDLES)
+@owner_only
 async def btn_bundles(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): return
     await state.set_state(BundleStates.waiting_pick_quiz_for_bundle)
-    await msg.answer("اختر الاختبار لإنشاء/عرض المرفقات المشتركة:", reply_markup=paged_quizzes_kb(0,"bund_pickq"))
+    await msg.answer("اختر الاختبار لإنشاء/عرض المرفقات المشتركة:", reply_markup=await paged_quizzes_kb(0,"bund_pickq"))
 
 @dp.message(F.text == BTN_BULK_IMPORT)
+@owner_only
 async def btn_bulk_import(msg: Message, state: FSMContext):
-    if not await ensure_owner(msg): return
     await state.set_state(BulkStates.waiting_pick_quiz)
-    await msg.answer("اختر الاختبار لاستيراد الأسئلة إليه:", reply_markup=paged_quizzes_kb(0, "bulk_pickq"))
+    await msg.answer("اختر الاختبار لاستيراد الأسئلة إليه:", reply_markup=await paged_quizzes_kb(0, "bulk_pickq"))
 
 @dp.message(F.text == BTN_MERGE)
+@owner_only
 async def btn_merge(msg: Message, state:FSMContext):
-    if not await ensure_owner(msg): return
     await state.set_state(MergeStates.waiting_pick_src)
-    await msg.answer("🔗 اختاري الاختبار الأول (المصدر 1):", reply_markup=paged_quizzes_kb(0, "merge_src"))
+    await msg.answer("🔗 اختاري الاختبار الأول (المصدر 1):", reply_markup=await paged_quizzes_kb(0, "merge_src"))
 
 @dp.message(F.text == BTN_EXPORT)
+@owner_only
 async def btn_export(msg: Message, state:FSMContext):
-    if not await ensure_owner(msg): return
     await state.set_state(ExportStates.waiting_pick_quiz)
-    await msg.answer("📤 اختاري الاختبار لتصديره:", reply_markup=paged_quizzes_kb(0, "export_pick"))
+    await msg.answer("📤 اختاري الاختبار لتصديره:", reply_markup=await paged_quizzes_kb(0, "export_pick"))
 
 @dp.message(F.text == BTN_PUBLISH)
+@owner_only
 async def btn_publish(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): return
     if msg.chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
-        return await msg.reply("افتح هذا الخيار داخل المجموعة لنشر الاختبار.", reply_markup=owner_panel_reply_kb())
+        return await msg.reply("افتح هذا الخيار داخل المجموعة لنشر الاختبار.", reply_markup=OWNER_PANEL_KB)
     await state.set_state(PublishStates.waiting_pick_quiz)
-    await msg.answer("اختر الاختبار لنشره:", reply_markup=paged_quizzes_kb(0,"pub_pickq"))
+    await msg.answer("اختر الاختبار لنشره:", reply_markup=await paged_quizzes_kb(0,"pub_pickq"))
 
 @dp.message(F.text == BTN_WIPE_ALL)
+@owner_only
 async def btn_wipe_all(msg:Message):
-    if not await ensure_owner(msg): return
-    kb = InlineKeyboardBuilder()
-    kb.button(text="✅ نعم", callback_data="yes:wipe")
-    kb.button(text="❌ لا", callback_data="no:wipe")
-    await msg.answer("هل تريد حذف كل البيانات؟", reply_markup=kb.as_markup())
+    await msg.answer("هل تريد حذف كل البيانات؟", reply_markup=WIPE_CONFIRM_KB)
 
 @dp.message(F.text == BTN_SCORE)
+@owner_only
 async def btn_score(msg:Message):
-    if not await ensure_owner(msg): return
-    await msg.answer("اختر اختبار لعرض النتائج:", reply_markup=paged_quizzes_kb(0,"score_pickq"))
+    await msg.answer("اختر اختبار لعرض النتائج:", reply_markup=await paged_quizzes_kb(0,"score_pickq"))
 
 # ---------------------- Create quiz ----------------------
 @dp.message(BuildStates.waiting_title, F.text)
+@owner_only
 async def receive_title(msg: Message, state: FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     title = msg.text.strip()
-    with db() as conn:
-        cur = conn.execute("INSERT INTO quizzes(title, created_by, created_at) VALUES (?,?,?)",
-                           (title, OWNER_ID, datetime.now(timezone.utc).isoformat()))
-        build_session.quiz_id = cur.lastrowid; conn.commit()
+    quiz_id = await aexec("INSERT INTO quizzes(title, created_by, created_at) VALUES (?,?,?)",
+                          (title, OWNER_ID, now_iso()))
+    invalidate_kb_cache()
     await state.clear()
-    await msg.answer(f"✅ تم إنشاء الاختبار (<code>{build_session.quiz_id}</code>): <b>{title}</b>", reply_markup=owner_panel_reply_kb())
+    await msg.answer(f"✅ تم إنشاء الاختبار (<code>{quiz_id}</code>): <b>{title}</b>", reply_markup=OWNER_PANEL_KB)
 
 # ---------------------- Bundles (shared attachments) ----------------------
-@dp.callback_query(F.data.startswith("bund_pickq_page:"))
+@cb_route("bund_pickq_page")
 async def bundles_page(cb:CallbackQuery, state:FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(int(page),"bund_pickq"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(int(page),"bund_pickq"))
 
-@dp.callback_query(F.data.startswith("bund_pickq:"), BundleStates.waiting_pick_quiz_for_bundle)
+@cb_route("bund_pickq", BundleStates.waiting_pick_quiz_for_bundle)
 async def bundles_for_quiz(cb:CallbackQuery, state:FSMContext):
     _, quiz_id = cb.data.split(":",1)
     await state.update_data(quiz_id=int(quiz_id), bundle_pos=0, bundle_id=None)
-    with db() as conn:
-        cur = conn.execute("INSERT INTO media_bundles(quiz_id, created_at) VALUES (?,?)",
-                           (int(quiz_id), datetime.now(timezone.utc).isoformat()))
-        bundle_id = cur.lastrowid; conn.commit()
+    bundle_id = await aexec("INSERT INTO media_bundles(quiz_id, created_at) VALUES (?,?)",
+                            (int(quiz_id), now_iso()))
+    invalidate_kb_cache()
     await state.update_data(bundle_id=bundle_id)
     await state.set_state(BundleStates.waiting_bundle_files)
     await cb.message.edit_text(f"أرسل حتى 5 مرفقات للحزمة رقم {bundle_id}. عند الانتهاء اكتب <b>تم</b>.")
 
 @dp.message(BundleStates.waiting_bundle_files, F.text)
+@owner_only
 async def bundle_done_if_text(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
-    if (msg.text or "").strip().lower() == "تم":
+    if msg.text and msg.text.strip() == "تم":
         await state.clear()
-        await msg.answer("تم حفظ الحزمة. الآن اربطي الأسئلة بها من 'إضافة سؤال' → 'استخدام مرفق مشترك'.", reply_markup=owner_panel_reply_kb())
+        await msg.answer("تم حفظ الحزمة. الآن اربطي الأسئلة بها من 'إضافة سؤال' → 'استخدام مرفق مشترك'.", reply_markup=OWNER_PANEL_KB)
     else:
         await msg.reply("أرسل مرفق (صورة/صوت/ملف صوتي) أو اكتب <b>تم</b> للإنهاء.")
 
 @dp.message(BundleStates.waiting_bundle_files, F.photo | F.voice | F.audio)
+@owner_only
 async def bundle_add_file(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     data = await state.get_data(); pos = int(data.get("bundle_pos",0))
     if pos >= 5: return await msg.reply("بلغتِ الحد الأقصى (5). اكتبي <b>تم</b> للإنهاء.")
-    if msg.photo: kind, file_id = "photo", msg.photo[-1].file_id
-    elif msg.voice: kind, file_id = "voice", msg.voice.file_id
-    elif msg.audio: kind, file_id = "audio", msg.audio.file_id
-    else: return await msg.reply("نوع غير مدعوم.")
-    with db() as conn:
-        conn.execute("""INSERT INTO media_bundle_attachments(bundle_id, kind, file_id, position)
-                        VALUES (?,?,?,?)""", (int(data["bundle_id"]), kind, file_id, pos))
-        conn.commit()
+    media = extract_media(msg)
+    if media is None: return await msg.reply("نوع غير مدعوم.")
+    kind, file_id = media
+    await aexec(SQL_INS_BATT, (int(data["bundle_id"]), kind, file_id, pos))
+    invalidate_kb_cache()
     await state.update_data(bundle_pos=pos+1)
     await msg.reply(f"تم إضافة المرفق ({pos+1}/5).")
 
 # ---------------------- Add Question ----------------------
-@dp.callback_query(F.data.startswith("pick_for_addq_page:"))
+@cb_route("pick_for_addq_page")
 async def page_pick_for_addq(cb:CallbackQuery, state: FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(page=int(page), tag="pick_for_addq"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(page=int(page), tag="pick_for_addq"))
 
-@dp.callback_query(F.data.startswith("pick_for_addq:"))
+@cb_route("pick_for_addq")
 async def picked_quiz_for_addq(cb: CallbackQuery, state: FSMContext):
     _, qid = cb.data.split(":",1)
-    build_session.quiz_id = int(qid)
-    build_session.att_count = 0
+    await state.update_data(quiz_id=int(qid))
     await state.set_state(BuildStates.waiting_q_text)
     await cb.message.edit_text("أرسل نص السؤال:")
 
 @dp.message(BuildStates.waiting_q_text, F.text)
+@owner_only
 async def receive_q_text(msg: Message, state: FSMContext):
     data = await state.get_data()
     qid_for_edit = data.get("question_id")
     if qid_for_edit:
-        if not await ensure_owner(msg): await state.clear(); return
-        with db() as conn:
-            conn.execute("UPDATE questions SET text=? WHERE id=?", (msg.text.strip(), int(qid_for_edit)))
-            conn.commit()
+        await aexec("UPDATE questions SET text=? WHERE id=?", (msg.text.strip(), int(qid_for_edit)))
+        invalidate_question_cache(int(qid_for_edit)); invalidate_kb_cache()
         await state.clear()
-        return await msg.answer("تم تحديث نص السؤال.", reply_markup=owner_panel_reply_kb())
-    if not await ensure_owner(msg): await state.clear(); return
-    with db() as conn:
-        cur = conn.execute("INSERT INTO questions(quiz_id, text, created_at) VALUES (?,?,?)",
-                           (build_session.quiz_id, msg.text.strip(), datetime.now(timezone.utc).isoformat()))
-        build_session.tmp_question_id = cur.lastrowid; conn.commit()
-    build_session.att_count = 0
+        return await msg.answer("تم تحديث نص السؤال.", reply_markup=OWNER_PANEL_KB)
+    tmp_question_id = await aexec("INSERT INTO questions(quiz_id, text, created_at) VALUES (?,?,?)",
+                                  (int(data["quiz_id"]), msg.text.strip(), now_iso()))
+    invalidate_qids_cache(int(data["quiz_id"])); invalidate_kb_cache()
+    await state.update_data(tmp_question_id=tmp_question_id, att_count=0)
     await state.set_state(BuildStates.waiting_attach_mode)
-    await msg.answer("اختر طريقة المرفقات لهذا السؤال:", reply_markup=attach_mode_kb())
+    await msg.answer("اختر طريقة المرفقات لهذا السؤال:", reply_markup=ATTACH_MODE_KB)
 
-@dp.callback_query(F.data.startswith("attach_mode:"), BuildStates.waiting_attach_mode)
+@cb_route("attach_mode", BuildStates.waiting_attach_mode)
 async def choose_attach_mode(cb:CallbackQuery, state:FSMContext):
     mode = cb.data.split(":",1)[1]
     if mode == "bundle":
+        data = await state.get_data()
         await state.set_state(BuildStates.waiting_pick_bundle_for_q)
-        await cb.message.edit_text("اختر الحزمة:", reply_markup=paged_bundles_kb(build_session.quiz_id,0,"pickbundle_for_q"))
+        await cb.message.edit_text("اختر الحزمة:", reply_markup=await paged_bundles_kb(int(data["quiz_id"]),0,"pickbundle_for_q"))
     elif mode == "own":
         await state.set_state(BuildStates.waiting_q_attachments)
         await cb.message.edit_text("أرسل حتى 5 مرفقات لهذا السؤال. عند الانتهاء اكتب <b>تم</b>.")
@@ -819,116 +1049,108 @@ async def choose_attach_mode(cb:CallbackQuery, state:FSMContext):
         await state.set_state(BuildStates.waiting_options_count)
         await cb.message.edit_text("كم عدد الخيارات؟ (2-10)")
 
-@dp.callback_query(F.data.startswith("pickbundle_for_q_page:"), BuildStates.waiting_pick_bundle_for_q)
+@cb_route("pickbundle_for_q_page", BuildStates.waiting_pick_bundle_for_q)
 async def page_pickbundle_q(cb:CallbackQuery, state:FSMContext):
     _, quiz_id, page = cb.data.split(":",2)
-    await cb.message.edit_reply_markup(reply_markup=paged_bundles_kb(int(quiz_id), int(page), "pickbundle_for_q"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_bundles_kb(int(quiz_id), int(page), "pickbundle_for_q"))
 
-@dp.callback_query(F.data.startswith("pickbundle_for_q:"), BuildStates.waiting_pick_bundle_for_q)
+@cb_route("pickbundle_for_q", BuildStates.waiting_pick_bundle_for_q)
 async def picked_bundle_for_q(cb:CallbackQuery, state:FSMContext):
     _, quiz_id, bundle_id = cb.data.split(":",2)
-    bundle_id = int(bundle_id)
-    with db() as conn:
-        conn.execute("UPDATE questions SET media_bundle_id=? WHERE id=?", (bundle_id, build_session.tmp_question_id))
-        conn.commit()
+    bundle_id = int(bundle_id); data = await state.get_data()
+    await aexec("UPDATE questions SET media_bundle_id=? WHERE id=?", (bundle_id, data["tmp_question_id"]))
+    invalidate_kb_cache()
     await state.set_state(BuildStates.waiting_options_count)
     await cb.message.edit_text("تم الربط بالحزمة.\nكم عدد الخيارات؟ (2-10)")
 
 @dp.message(BuildStates.waiting_q_attachments, F.text)
+@owner_only
 async def finish_attachments_if_text(msg: Message, state: FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
-    if (msg.text or "").strip().lower() == "تم":
+    if msg.text and msg.text.strip() == "تم":
         await state.set_state(BuildStates.waiting_options_count)
-        await msg.answer("كم عدد الخيارات؟ (2-10)", reply_markup=owner_panel_reply_kb())
+        await msg.answer("كم عدد الخيارات؟ (2-10)", reply_markup=OWNER_PANEL_KB)
     else:
         await msg.reply("أرسل مرفق أو اكتب <b>تم</b> للمتابعة.")
 
 @dp.message(BuildStates.waiting_q_attachments, F.photo | F.voice | F.audio)
+@owner_only
 async def receive_attachment(msg: Message, state: FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
-    if build_session.att_count >= 5:
+    data = await state.get_data(); att_count = int(data.get("att_count", 0))
+    if att_count >= 5:
         return await msg.reply("وصلتِ للحد الأقصى (5). أرسلي <b>تم</b> للمتابعة.")
-    if msg.photo: kind, file_id = "photo", msg.photo[-1].file_id
-    elif msg.voice: kind, file_id = "voice", msg.voice.file_id
-    elif msg.audio: kind, file_id = "audio", msg.audio.file_id
-    else: return await msg.reply("نوع مرفق غير مدعوم.")
-    with db() as conn:
-        conn.execute("""INSERT INTO question_attachments(question_id, kind, file_id, position)
-                        VALUES (?,?,?,?)""", (build_session.tmp_question_id, kind, file_id, build_session.att_count))
-        conn.commit()
-    build_session.att_count += 1
-    await msg.reply(f"تم حفظ المرفق ({build_session.att_count}/5). أرسلي المزيد أو اكتبي <b>تم</b>.")
+    media = extract_media(msg)
+    if media is None: return await msg.reply("نوع مرفق غير مدعوم.")
+    kind, file_id = media
+    await aexec(SQL_INS_QATT, (data["tmp_question_id"], kind, file_id, att_count))
+    await state.update_data(att_count=att_count+1)
+    await msg.reply(f"تم حفظ المرفق ({att_count+1}/5). أرسلي المزيد أو اكتبي <b>تم</b>.")
 
 # options for new question
 @dp.message(BuildStates.waiting_options_count, F.text)
+@owner_only
 async def receive_options_count(msg: Message, state: FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     try:
         n = int(msg.text.strip())
         if n < 2 or n > 10: raise ValueError
     except ValueError:
         return await msg.reply("أدخل رقمًا بين 2 و 10.")
-    build_session.options_needed = n
-    build_session.options_collected = 0
+    await state.update_data(options_needed=n, options_collected=0)
     await state.set_state(BuildStates.waiting_option_text)
-    await msg.answer(f"أرسل نص الخيار 1 من {n}:", reply_markup=owner_panel_reply_kb())
+    await msg.answer(f"أرسل نص الخيار 1 من {n}:", reply_markup=OWNER_PANEL_KB)
 
 @dp.message(BuildStates.waiting_option_text, F.text)
+@owner_only
 async def receive_option_text(msg: Message, state: FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
-    idx = build_session.options_collected
-    with db() as conn:
-        conn.execute("INSERT INTO options(question_id, option_index, text) VALUES (?,?,?)",
-                     (build_session.tmp_question_id, idx, msg.text.strip()))
-        conn.commit()
-    build_session.options_collected += 1
-    if build_session.options_collected < build_session.options_needed:
-        await msg.answer(f"أرسل نص الخيار {build_session.options_collected+1} من {build_session.options_needed}:", reply_markup=owner_panel_reply_kb())
+    data = await state.get_data()
+    qid = data["tmp_question_id"]; idx = int(data["options_collected"]); needed = int(data["options_needed"])
+    await aexec(SQL_INS_OPT, (qid, idx, msg.text.strip(), 0))
+    invalidate_question_cache(qid)
+    await state.update_data(options_collected=idx+1)
+    if idx + 1 < needed:
+        await msg.answer(f"أرسل نص الخيار {idx+2} من {needed}:", reply_markup=OWNER_PANEL_KB)
     else:
         await state.set_state(BuildStates.waiting_correct_index)
-        await msg.answer(f"أرسل رقم الخيار الصحيح (1-{build_session.options_needed}):", reply_markup=owner_panel_reply_kb())
+        await msg.answer(f"أرسل رقم الخيار الصحيح (1-{needed}):", reply_markup=OWNER_PANEL_KB)
 
 @dp.message(BuildStates.waiting_correct_index, F.text)
+@owner_only
 async def receive_correct_index(msg: Message, state: FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
+    data = await state.get_data()
     try:
         i = int(msg.text.strip())
-        if i < 1 or i > build_session.options_needed: raise ValueError
+        if i < 1 or i > int(data["options_needed"]): raise ValueError
     except ValueError:
         return await msg.reply("أدخل رقمًا صحيحًا ضمن النطاق.")
     correct_idx0 = i - 1
-    with db() as conn:
-        conn.execute("UPDATE options SET is_correct=1 WHERE question_id=? AND option_index=?",
-                     (build_session.tmp_question_id, correct_idx0))
-        conn.commit()
+    await aexec(SQL_UPD_OPT_CORRECT, (correct_idx0, data["tmp_question_id"]))
+    invalidate_question_cache(data["tmp_question_id"])
     await state.clear()
-    await msg.answer("✅ تم حفظ السؤال والخيارات.", reply_markup=owner_panel_reply_kb())
+    await msg.answer("✅ تم حفظ السؤال والخيارات.", reply_markup=OWNER_PANEL_KB)
 
 # ---------------------- List / Manage Questions ----------------------
-@dp.callback_query(F.data.startswith("listq_pickq_page:"), BuildStates.waiting_pick_quiz_generic)
+@cb_route("listq_pickq_page", BuildStates.waiting_pick_quiz_generic)
 async def cb_list_questions_page(cb: CallbackQuery, state:FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(page=int(page), tag="listq_pickq"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(page=int(page), tag="listq_pickq"))
 
-@dp.callback_query(F.data.startswith("listq_pickq:"), BuildStates.waiting_pick_quiz_generic)
+@cb_route("listq_pickq", BuildStates.waiting_pick_quiz_generic)
 async def cb_list_questions_show(cb: CallbackQuery, state:FSMContext):
     _, quiz_id = cb.data.split(":",1)
     await state.update_data(quiz_id=int(quiz_id))
     await state.set_state(BuildStates.waiting_manage_question_pick)
-    await cb.message.edit_text("اختر سؤالًا لإدارته:", reply_markup=paged_questions_kb(int(quiz_id), page=0, tag="manageq"))
+    await cb.message.edit_text("اختر سؤالًا لإدارته:", reply_markup=await paged_questions_kb(int(quiz_id), page=0, tag="manageq"))
 
-@dp.callback_query(F.data.startswith("manageq_page:"), BuildStates.waiting_manage_question_pick)
+@cb_route("manageq_page", BuildStates.waiting_manage_question_pick)
 async def cb_manageq_page(cb:CallbackQuery, state:FSMContext):
     _, quiz_id, page = cb.data.split(":",2)
-    await cb.message.edit_reply_markup(reply_markup=paged_questions_kb(int(quiz_id), int(page), tag="manageq"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_questions_kb(int(quiz_id), int(page), tag="manageq"))
 
-@dp.callback_query(F.data.startswith("manageq:"), BuildStates.waiting_manage_question_pick)
+@cb_route("manageq", BuildStates.waiting_manage_question_pick)
 async def cb_manageq_open(cb:CallbackQuery, state:FSMContext):
     _, quiz_id, qid, page = cb.data.split(":",3)
     quiz_id = int(quiz_id); qid = int(qid); page = int(page)
-    with db() as conn:
-        qrow = conn.execute("SELECT * FROM questions WHERE id=?", (qid,)).fetchone()
-    txt = question_card_text(qrow)
+    qrow = await fetch_one("SELECT * FROM questions WHERE id=?", (qid,))
+    txt = await question_card_text(qrow)
     kb = InlineKeyboardBuilder()
     kb.button(text=ACT_EDIT_TEXT,  callback_data=f"m_edit_text:{quiz_id}:{qid}:{page}")
     kb.button(text=ACT_EDIT_OPTS,  callback_data=f"m_edit_opts:{quiz_id}:{qid}:{page}")
@@ -938,19 +1160,19 @@ async def cb_manageq_open(cb:CallbackQuery, state:FSMContext):
     kb.adjust(1)
     await cb.message.edit_text(txt, reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("m_back:"))
+@cb_route("m_back")
 async def cb_manage_back(cb:CallbackQuery):
     _, quiz_id, page = cb.data.split(":",2)
-    await cb.message.edit_text("اختر سؤالًا لإدارته:", reply_markup=paged_questions_kb(int(quiz_id), int(page), tag="manageq"))
+    await cb.message.edit_text("اختر سؤالًا لإدارته:", reply_markup=await paged_questions_kb(int(quiz_id), int(page), tag="manageq"))
 
-@dp.callback_query(F.data.startswith("m_edit_text:"))
+@cb_route("m_edit_text")
 async def cb_m_edit_text(cb:CallbackQuery, state:FSMContext):
     _, quiz_id, qid, page = cb.data.split(":",3)
     await state.update_data(quiz_id=int(quiz_id), question_id=int(qid), page=int(page))
     await state.set_state(BuildStates.waiting_q_text)
     await cb.message.edit_text("أرسل النص الجديد للسؤال:")
 
-@dp.callback_query(F.data.startswith("m_edit_opts:"))
+@cb_route("m_edit_opts")
 async def cb_m_edit_opts(cb:CallbackQuery, state:FSMContext):
     _, quiz_id, qid, page = cb.data.split(":",3)
     await state.update_data(quiz_id=int(quiz_id), question_id=int(qid), page=int(page))
@@ -958,8 +1180,8 @@ async def cb_m_edit_opts(cb:CallbackQuery, state:FSMContext):
     await cb.message.edit_text("أدخل عدد الخيارات الجديد (2-10):")
 
 @dp.message(EditOptionStates.waiting_count, F.text)
+@owner_only
 async def m_opts_count(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     try:
         n = int(msg.text.strip()); 
         if n<2 or n>10: raise ValueError
@@ -967,44 +1189,39 @@ async def m_opts_count(msg:Message, state:FSMContext):
         return await msg.reply("أدخل رقمًا بين 2 و 10.")
     await state.update_data(n=n, i=0)
     await state.set_state(EditOptionStates.waiting_text)
-    await msg.answer("أرسل نص الخيار 1:", reply_markup=owner_panel_reply_kb())
+    await msg.answer("أرسل نص الخيار 1:", reply_markup=OWNER_PANEL_KB)
 
 @dp.message(EditOptionStates.waiting_text, F.text)
+@owner_only
 async def m_opts_text(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     data = await state.get_data()
     n = int(data["n"]); i = int(data["i"]); qid = int(data["question_id"])
     if i == 0:
-        with db() as conn:
-            conn.execute("DELETE FROM options WHERE question_id=?", (qid,))
-            conn.commit()
-    with db() as conn:
-        conn.execute("INSERT INTO options(question_id, option_index, text) VALUES (?,?,?)", (qid, i, msg.text.strip()))
-        conn.commit()
+        await aexec("DELETE FROM options WHERE question_id=?", (qid,))
+    await aexec(SQL_INS_OPT, (qid, i, msg.text.strip(), 0))
+    invalidate_question_cache(qid)
     i += 1; await state.update_data(i=i)
     if i < n:
-        await msg.answer(f"أرسل نص الخيار {i+1}:", reply_markup=owner_panel_reply_kb())
+        await msg.answer(f"أرسل نص الخيار {i+1}:", reply_markup=OWNER_PANEL_KB)
     else:
         await state.set_state(EditOptionStates.waiting_correct)
-        await msg.answer(f"أرسل رقم الخيار الصحيح (1-{n}):", reply_markup=owner_panel_reply_kb())
+        await msg.answer(f"أرسل رقم الخيار الصحيح (1-{n}):", reply_markup=OWNER_PANEL_KB)
 
 @dp.message(EditOptionStates.waiting_correct, F.text)
+@owner_only
 async def m_opts_correct(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     data = await state.get_data(); n = int(data["n"]); qid = int(data["question_id"])
     try:
         k = int(msg.text.strip()); 
         if k<1 or k>n: raise ValueError
     except ValueError:
         return await msg.reply("رقم غير صحيح.")
-    with db() as conn:
-        conn.execute("UPDATE options SET is_correct=0 WHERE question_id=?", (qid,))
-        conn.execute("UPDATE options SET is_correct=1 WHERE question_id=? AND option_index=?", (qid, k-1))
-        conn.commit()
+    await aexec(SQL_UPD_OPT_CORRECT, (k-1, qid))
+    invalidate_question_cache(qid)
     await state.clear()
-    await msg.answer("تم تحديث الخيارات.", reply_markup=owner_panel_reply_kb())
+    await msg.answer("تم تحديث الخيارات.", reply_markup=OWNER_PANEL_KB)
 
-@dp.callback_query(F.data.startswith("m_edit_media:"))
+@cb_route("m_edit_media")
 async def cb_m_edit_media(cb:CallbackQuery, state:FSMContext):
     _, quiz_id, qid, page = cb.data.split(":",3)
     await state.update_data(question_id=int(qid))
@@ -1012,105 +1229,95 @@ async def cb_m_edit_media(cb:CallbackQuery, state:FSMContext):
     await cb.message.edit_text("أرسل حتى 5 مرفقات جديدة (سيتم استبدال القديمة). عند الانتهاء أرسل: <b>تم</b>.")
 
 @dp.message(BuildStates.waiting_replace_attachments, F.text)
+@owner_only
 async def ch_media_finish_if_text(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
-    if (msg.text or '').strip().lower() == "تم":
+    if msg.text and msg.text.strip() == "تم":
         await state.clear()
-        await msg.answer("تم تحديث المرفقات.", reply_markup=owner_panel_reply_kb())
+        await msg.answer("تم تحديث المرفقات.", reply_markup=OWNER_PANEL_KB)
     else:
         await msg.reply("أرسل مرفقات أو اكتب <b>تم</b> حين الانتهاء.")
 
 @dp.message(BuildStates.waiting_replace_attachments, F.photo | F.voice | F.audio)
+@owner_only
 async def ch_media_collect(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     data = await state.get_data(); qid = int(data["question_id"]); pos = int(data.get("pos",0))
     if pos == 0:
-        with db() as conn:
-            conn.execute("DELETE FROM question_attachments WHERE question_id=?", (qid,))
-            conn.commit()
+        await aexec("DELETE FROM question_attachments WHERE question_id=?", (qid,))
     if pos >= 5: return await msg.reply("الحد الأقصى 5. اكتب <b>تم</b> للإنهاء.")
-    if msg.photo: kind, file_id = "photo", msg.photo[-1].file_id
-    elif msg.voice: kind, file_id = "voice", msg.voice.file_id
-    elif msg.audio: kind, file_id = "audio", msg.audio.file_id
-    else: return await msg.reply("نوع غير مدعوم.")
-    with db() as conn:
-        conn.execute("""INSERT INTO question_attachments(question_id, kind, file_id, position) VALUES (?,?,?,?)""",
-                     (qid, kind, file_id, pos))
-        conn.commit()
+    media = extract_media(msg)
+    if media is None: return await msg.reply("نوع غير مدعوم.")
+    kind, file_id = media
+    await aexec(SQL_INS_QATT, (qid, kind, file_id, pos))
     await state.update_data(pos=pos+1)
     await msg.reply(f"تم حفظ المرفق ({pos+1}/5).")
 
-@dp.callback_query(F.data.startswith("m_delete_q:"))
+@cb_route("m_delete_q")
 async def cb_m_delete(cb:CallbackQuery):
     _, quiz_id, qid, page = cb.data.split(":",3)
-    with db() as conn:
-        conn.execute("DELETE FROM questions WHERE id=?", (int(qid),))
-        conn.commit()
-    await cb.message.edit_text("🗑️ تم حذف السؤال.", reply_markup=paged_questions_kb(int(quiz_id), int(page), tag="manageq"))
+    await aexec("DELETE FROM questions WHERE id=?", (int(qid),))
+    invalidate_question_cache(int(qid)); invalidate_qids_cache(int(quiz_id)); invalidate_kb_cache()
+    await cb.message.edit_text("🗑️ تم حذف السؤال.", reply_markup=await paged_questions_kb(int(quiz_id), int(page), tag="manageq"))
 
 # ---------------------- Edit/Delete Quiz & List ----------------------
-@dp.callback_query(F.data.startswith("overview_q_page:"))
+@cb_route("overview_q_page")
 async def cb_list_quizzes_page(cb: CallbackQuery):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(page=int(page), tag="overview_q"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(page=int(page), tag="overview_q"))
 
-@dp.callback_query(F.data.startswith("overview_q:"))
+@cb_route("overview_q")
 async def cb_overview_quiz(cb: CallbackQuery):
     _, qid = cb.data.split(":",1)
-    with db() as conn:
-        q = conn.execute("SELECT * FROM quizzes WHERE id=?", (int(qid),)).fetchone()
-        cnt = conn.execute("SELECT COUNT(*) FROM questions WHERE quiz_id=?", (int(qid),)).fetchone()[0]
+    q = await fetch_one("SELECT title, id, (SELECT COUNT(*) FROM questions WHERE quiz_id=quizzes.id) AS cnt FROM quizzes WHERE id=?", (int(qid),))
+    cnt = q["cnt"]
     await cb.message.edit_text(f"اختبار: <b>{q['title']}</b>\nعدد الأسئلة: <b>{cnt}</b>\n(id: <code>{q['id']}</code>)")
 
-@dp.callback_query(F.data.startswith("renameq_page:"), BuildStates.waiting_edit_quiz_title)
+@cb_route("renameq_page", BuildStates.waiting_edit_quiz_title)
 async def cb_renameq_page(cb:CallbackQuery, state:FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(int(page), "renameq"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(int(page), "renameq"))
 
-@dp.callback_query(F.data.startswith("renameq:"), BuildStates.waiting_edit_quiz_title)
+@cb_route("renameq", BuildStates.waiting_edit_quiz_title)
 async def cb_renameq_pick(cb:CallbackQuery, state:FSMContext):
     _, quiz_id = cb.data.split(":",1)
     await state.update_data(quiz_id=int(quiz_id))
     await cb.message.edit_text("أرسل العنوان الجديد:")
 
 @dp.message(BuildStates.waiting_edit_quiz_title, F.text)
+@owner_only
 async def cb_renameq_do(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     data = await state.get_data(); quiz_id = data["quiz_id"]
-    with db() as conn:
-        conn.execute("UPDATE quizzes SET title=? WHERE id=?", (msg.text.strip(), quiz_id))
-        conn.commit()
+    await aexec("UPDATE quizzes SET title=? WHERE id=?", (msg.text.strip(), quiz_id))
+    invalidate_kb_cache()
     await state.clear()
-    await msg.answer("تم تحديث العنوان.", reply_markup=owner_panel_reply_kb())
+    await msg.answer("تم تحديث العنوان.", reply_markup=OWNER_PANEL_KB)
 
-@dp.callback_query(F.data.startswith("delqz_page:"), BuildStates.waiting_pick_quiz_generic)
+@cb_route("delqz_page", BuildStates.waiting_pick_quiz_generic)
 async def cb_del_quiz_page(cb:CallbackQuery, state:FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(int(page), "delqz"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(int(page), "delqz"))
 
-@dp.callback_query(F.data.startswith("delqz:"), BuildStates.waiting_pick_quiz_generic)
+@cb_route("delqz", BuildStates.waiting_pick_quiz_generic)
 async def cb_del_quiz_do(cb:CallbackQuery, state:FSMContext):
     _, quiz_id = cb.data.split(":",1)
-    with db() as conn:
-        conn.execute("DELETE FROM quizzes WHERE id=?", (int(quiz_id),))
-        conn.commit()
+    await aexec("DELETE FROM quizzes WHERE id=?", (int(quiz_id),))
+    invalidate_qids_cache(int(quiz_id)); invalidate_kb_cache()
     await state.clear()
     await cb.message.edit_text("🗑️ تم حذف الاختبار وما يتبعه.")
 
 # ---------------------- Publish (with time limit) ----------------------
-@dp.callback_query(F.data.startswith("pub_pickq_page:"), PublishStates.waiting_pick_quiz)
+@cb_route("pub_pickq_page", PublishStates.waiting_pick_quiz)
 async def cb_pub_page(cb:CallbackQuery, state:FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(int(page), "pub_pickq"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(int(page), "pub_pickq"))
 
-@dp.callback_query(F.data.startswith("pub_pickq:"), PublishStates.waiting_pick_quiz)
+@cb_route("pub_pickq", PublishStates.waiting_pick_quiz)
 async def cb_pub_choose_duration(cb:CallbackQuery, state:FSMContext):
     _, quiz_id = cb.data.split(":",1)
     await state.update_data(quiz_id=int(quiz_id))
     await state.set_state(PublishStates.waiting_duration_choice)
-    await cb.message.edit_text("حددي مدة الاختبار:", reply_markup=publish_duration_kb())
+    await cb.message.edit_text("حددي مدة الاختبار:", reply_markup=PUBLISH_DURATION_KB)
 
-@dp.callback_query(F.data.startswith("dur:"), PublishStates.waiting_duration_choice)
+@cb_route("dur", PublishStates.waiting_duration_choice)
 async def cb_pub_duration_selected(cb:CallbackQuery, state:FSMContext):
     _, sel = cb.data.split(":",1)
     data = await state.get_data(); quiz_id = int(data["quiz_id"])
@@ -1125,113 +1332,112 @@ async def cb_pub_duration_selected(cb:CallbackQuery, state:FSMContext):
     await _do_publish(cb, quiz_id, expires_at); await state.clear()
 
 @dp.message(PublishStates.waiting_custom_hours, F.text)
+@owner_only
 async def cb_pub_custom_hours(msg:Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     data = await state.get_data(); quiz_id = int(data["quiz_id"])
     try:
         hours = int(msg.text.strip()); 
         if hours <= 0 or hours > 240: raise ValueError
     except ValueError:
-        return await msg.reply("أدخل رقم ساعات صحيح (1 إلى 240).", reply_markup=owner_panel_reply_kb())
+        return await msg.reply("أدخل رقم ساعات صحيح (1 إلى 240).", reply_markup=OWNER_PANEL_KB)
     expires_at = (datetime.now(timezone.utc) + timedelta(hours=hours)).isoformat()
     class Dummy: pass
     dummy = Dummy(); dummy.message = msg; dummy.from_user = msg.from_user
     await _do_publish(dummy, quiz_id, expires_at); await state.clear()
 
 # ---- Robust publish ----
-RATE_LIMIT_SECONDS = 0.05
-
-async def _safe_send(op, *args, **kwargs):
+async def _safe_send(op, chat_id:int, *args, **kwargs):
     try:
-        msg = await op(*args, **kwargs)
-        await asyncio.sleep(RATE_LIMIT_SECONDS)
-        return msg
+        async with chat_limiter(chat_id), GLOBAL_LIMITER:
+            return await op(chat_id, *args, **kwargs)
     except TelegramRetryAfter as e:
         wait = getattr(e, "retry_after", 1) or 1
         await asyncio.sleep(wait)
         try:
-            msg = await op(*args, **kwargs)
-            await asyncio.sleep(RATE_LIMIT_SECONDS)
-            return msg
+            async with chat_limiter(chat_id), GLOBAL_LIMITER:
+                return await op(chat_id, *args, **kwargs)
         except Exception:
             return None
     except Exception:
         return None
 
+async def _send_att(chat_id:int, att, **kwargs):
+    op = {"photo": bot.send_photo, "voice": bot.send_voice}.get(att["kind"], bot.send_audio)
+    return await _safe_send(op, chat_id, att["file_id"], **kwargs)
+
+async def _send_run(chat_id:int, run) -> list:
+    if len(run) == 1: return [await _send_att(chat_id, run[0])]
+    media = [MEDIA_GROUP_TYPES[a["kind"]](media=a["file_id"]) for a in run]
+    return await _safe_send(bot.send_media_group, chat_id, media) or []
+
+async def _load_publish_data(quiz_id:int) -> Tuple[Dict[int, List[sqlite3.Row]], ...]:
+    """Options, question attachments and bundle attachments of a quiz in three queries, grouped by owner id."""
+    async with pool.connection() as conn:
+        opts_by_q = _group_rows(await conn.execute_fetchall(
+            """SELECT question_id, option_index, text FROM options
+               WHERE question_id IN (SELECT id FROM questions WHERE quiz_id=?)
+               ORDER BY question_id, option_index""", (quiz_id,)), "question_id")
+        atts_by_q = _group_rows(await conn.execute_fetchall(
+            """SELECT question_id, kind, file_id, position FROM question_attachments
+               WHERE question_id IN (SELECT id FROM questions WHERE quiz_id=?)
+               ORDER BY question_id, position""", (quiz_id,)), "question_id")
+        batts_by_b = _group_rows(await conn.execute_fetchall(
+            """SELECT bundle_id, kind, file_id, position FROM media_bundle_attachments
+               WHERE bundle_id IN (SELECT media_bundle_id FROM questions WHERE quiz_id=?)
+               ORDER BY bundle_id, position""", (quiz_id,)), "bundle_id")
+    return opts_by_q, atts_by_q, batts_by_b
+
 async def _do_publish(cb_or_msg, quiz_id:int, expires_at: Optional[str]):
-    migrate_legacy_media()
     chat_id = cb_or_msg.message.chat.id
-    with db() as conn:
-        quiz = conn.execute("SELECT * FROM quizzes WHERE id=? AND is_archived=0",(quiz_id,)).fetchone()
-        qs = conn.execute("SELECT id, text, media_bundle_id FROM questions WHERE quiz_id=? ORDER BY id",(quiz_id,)).fetchall()
+    quiz = await fetch_one("SELECT * FROM quizzes WHERE id=? AND is_archived=0",(quiz_id,))
+    qs = await fetch_rows("SELECT id, text, media_bundle_id FROM questions WHERE quiz_id=? ORDER BY id",(quiz_id,))
     if not quiz or not qs:
         return await bot.send_message(chat_id, "اختبار غير صالح أو بلا أسئلة.")
+    if expires_at: EXPIRY_CACHE[(chat_id, quiz_id)] = _parse_expiry(expires_at)
     exp_line = "بدون حدّ زمني" if not expires_at else f"حتى: <code>{expires_at}</code> (UTC)"
+    # payload loads while the head message is in flight; sends stay sequential to keep message order
+    data_fut = asyncio.ensure_future(_load_publish_data(quiz_id))
     kb_start = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🎓 ابدأ الحل", callback_data=f"start:{quiz_id}")]])
     m_head = await _safe_send(bot.send_message, chat_id, f"📣 اختبار: <b>{quiz['title']}</b>\nالوقت: {exp_line}\nاضغطي زر \"ابدأ الحل\" لكتابة اسمك ثم أجيبي على الأسئلة.", reply_markup=kb_start)
     if m_head:
-        with db() as conn:
-            conn.execute("INSERT INTO sent_msgs(chat_id, quiz_id, message_id, expires_at) VALUES (?,?,?,?)",
-                         (chat_id, quiz_id, m_head.message_id, expires_at))
-            conn.commit()
+        await aexec(SQL_INS_SENT, (chat_id, quiz_id, m_head.message_id, expires_at))
+    opts_by_q, atts_by_q, batts_by_b = await data_fut
+    sent_rows: List[tuple] = []  # flushed in one transaction after the loop
     sent_bundles = set()
     for q in qs:
-        qid = q["id"]; qtext = q["text"]; bundle_id = q["media_bundle_id"]
+        qid = q["id"]; qtext = q["text"]; bundle_id = q["media_bundle_id"]; atts_q = atts_by_q.get(qid, [])
+        kbq = build_options_kb_from(opts_by_q.get(qid, []), qid, 0)
         if bundle_id and bundle_id not in sent_bundles:
-            atts_bundle = get_bundle_atts(bundle_id)
-            for att in atts_bundle:
-                if att["kind"] == "photo":
-                    m = await _safe_send(bot.send_photo, chat_id, att["file_id"])
-                elif att["kind"] == "voice":
-                    m = await _safe_send(bot.send_voice, chat_id, att["file_id"])
-                else:
-                    m = await _safe_send(bot.send_audio, chat_id, att["file_id"])
-                if m:
-                    with db() as conn:
-                        conn.execute("INSERT INTO sent_msgs(chat_id, quiz_id, message_id, expires_at) VALUES (?,?,?,?)",
-                                     (chat_id, quiz_id, m.message_id, expires_at))
-                        conn.commit()
+            for run in media_runs(batts_by_b.get(bundle_id, [])):
+                ms = await _send_run(chat_id, run)
+                sent_rows.extend((chat_id, quiz_id, m.message_id, expires_at) for m in ms if m)
             sent_bundles.add(bundle_id)
-        kbq = build_options_kb(qid, 0)
-        atts_q = get_question_atts(qid)
-        if atts_q:
-            first = True
-            for att in atts_q:
-                if first:
-                    if att["kind"] == "photo":
-                        m = await _safe_send(bot.send_photo, chat_id, att["file_id"], caption=qtext, reply_markup=kbq)
-                    elif att["kind"] == "voice":
-                        m = await _safe_send(bot.send_voice, chat_id, att["file_id"], caption=qtext, reply_markup=kbq)
-                    else:
-                        m = await _safe_send(bot.send_audio, chat_id, att["file_id"], caption=qtext, reply_markup=kbq)
-                    first = False
-                else:
-                    if att["kind"] == "photo":
-                        m = await _safe_send(bot.send_photo, chat_id, att["file_id"])
-                    elif att["kind"] == "voice":
-                        m = await _safe_send(bot.send_voice, chat_id, att["file_id"])
-                    else:
-                        m = await _safe_send(bot.send_audio, chat_id, att["file_id"])
-                if m:
-                    with db() as conn:
-                        conn.execute("INSERT INTO sent_msgs(chat_id, quiz_id, message_id, expires_at) VALUES (?,?,?,?)",
-                                     (chat_id, quiz_id, m.message_id, expires_at))
-                        conn.commit()
+        if len(atts_q) == 1:
+            m = await _send_att(chat_id, atts_q[0], caption=qtext, reply_markup=kbq)
+            if m: sent_rows.append((chat_id, quiz_id, m.message_id, expires_at))
+        elif atts_q:
+            # albums can't carry a keyboard: send the media first, then the question with its options
+            for run in media_runs(atts_q):
+                ms = await _send_run(chat_id, run)
+                sent_rows.extend((chat_id, quiz_id, m.message_id, expires_at) for m in ms if m)
+            m = await _safe_send(bot.send_message, chat_id, qtext, reply_markup=kbq)
+            if m: sent_rows.append((chat_id, quiz_id, m.message_id, expires_at))
         else:
             m = await _safe_send(bot.send_message, chat_id, qtext, reply_markup=kbq)
-            if m:
-                with db() as conn:
-                    conn.execute("INSERT INTO sent_msgs(chat_id, quiz_id, message_id, expires_at) VALUES (?,?,?,?)",
-                                 (chat_id, quiz_id, m.message_id, expires_at))
-                    conn.commit()
+            if m: sent_rows.append((chat_id, quiz_id, m.message_id, expires_at))
+    if sent_rows:
+        async with pool.connection() as conn:
+            await conn.execute("BEGIN")
+            await conn.executemany(SQL_INS_SENT, sent_rows)
+            await conn.commit()
 
 # ---------------------- Bulk import flow ----------------------
-@dp.callback_query(F.data.startswith("bulk_pickq_page:"), BulkStates.waiting_pick_quiz)
+@cb_route("bulk_pickq_page", BulkStates.waiting_pick_quiz)
 async def cb_bulk_pick_page(cb: CallbackQuery, state:FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(int(page), "bulk_pickq"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(int(page), "bulk_pickq"))
 
-@dp.callback_query(F.data.startswith("bulk_pickq:"), BulkStates.waiting_pick_quiz)
+@cb_route("bulk_pickq", BulkStates.waiting_pick_quiz)
 async def cb_bulk_pick(cb: CallbackQuery, state:FSMContext):
     _, quiz_id = cb.data.split(":",1)
     await state.update_data(quiz_id=int(quiz_id))
@@ -1247,92 +1453,111 @@ async def cb_bulk_pick(cb: CallbackQuery, state:FSMContext):
     await cb.message.edit_text(txt)
 
 @dp.message(BulkStates.waiting_csv, F.document)
+@owner_only
 async def bulk_receive_csv_document(msg: Message, state: FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     file = msg.document
     if not (file.file_name or "").lower().endswith(".csv"):
         return await msg.reply("أرسل ملف بصيغة CSV.")
     try:
         f = await bot.get_file(file.file_id)
         content = await bot.download_file(f.file_path)
-        text = content.read().decode("utf-8", errors="replace")
+        text = await asyncio.to_thread(lambda: content.read().decode("utf-8", errors="replace"))
     except Exception as e:
         await state.clear()
         return await msg.reply(f"تعذّر قراءة الملف: {e}")
     await _consume_bulk_csv_text(msg, state, text)
 
 @dp.message(BulkStates.waiting_csv, F.text)
+@owner_only
 async def bulk_receive_csv_text(msg: Message, state:FSMContext):
-    if not await ensure_owner(msg): await state.clear(); return
     text = msg.text or ""
     await _consume_bulk_csv_text(msg, state, text)
 
+# csv parsing is pure Python: run it off the event loop, at most two files at a time
+CSV_PARSE_SEM = asyncio.Semaphore(2)
+
 async def _consume_bulk_csv_text(msg: Message, state:FSMContext, csv_text:str):
     data = await state.get_data()
     quiz_id = int(data["quiz_id"])
-    parsed = parse_bulk_csv(csv_text)
-    ok_count = 0; errors = []
-    for idx, item in enumerate(parsed, start=1):
-        if "_error" in item:
-            errors.append(item["_error"]); continue
+    ok_count = 0
+    async with CSV_PARSE_SEM:
+        idx, rows = await asyncio.to_thread(split_bulk_csv, csv_text)
+        items = await asyncio.to_thread(validate_bulk_rows, idx, rows)
+    errors = [item["_error"] for item in items if "_error" in item]
+    good = [item for item in items if "_error" not in item]
+    # rows are validated already: under BEGIN IMMEDIATE nobody else can allocate question ids,
+    # so the file's ids are reserved past the AUTOINCREMENT high-water mark and every table
+    # gets a single executemany
+    q_rows: List[tuple] = []; opt_rows: List[tuple] = []; att_rows: List[tuple] = []; ts = now_iso()
+    async with pool.connection() as conn:
         try:
-            insert_question_with_data(quiz_id, item["question"], item["options"], item["correct_index0"], item["attachments"])
-            ok_count += 1
+            await conn.execute("BEGIN IMMEDIATE")
+            async with conn.execute("""SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name='questions'), 0),
+                                                   COALESCE((SELECT MAX(id) FROM questions), 0))""") as cur:
+                base = (await cur.fetchone())[0]
+            for qid, item in enumerate(good, start=base + 1):
+                q_rows.append((qid, quiz_id, item["question"], ts))
+                o, a = question_child_rows(qid, item["options"], item["correct_index0"], item["attachments"])
+                opt_rows.extend(o); att_rows.extend(a)
+            await conn.executemany("INSERT INTO questions(id, quiz_id, text, created_at) VALUES (?,?,?,?)", q_rows)
+            await conn.executemany(SQL_INS_OPT, opt_rows)
+            await conn.executemany(SQL_INS_QATT, att_rows)
+            await conn.commit()
+            ok_count = len(good)
         except Exception as e:
-            errors.append(f"سطر {idx+1}: فشل الإدخال — {e}")
+            await conn.rollback()
+            ok_count = 0; errors.append(f"فشل الإدخال — {e}")
+    invalidate_qids_cache(quiz_id); invalidate_kb_cache()
     await state.clear()
     report = [f"تم الاستيراد ✅: {ok_count} سؤال."]
     if errors:
         report.append(f"أخطاء: {len(errors)} (أول 10):")
         for e in errors[:10]: report.append(f"- {e}")
-    await msg.reply("\n".join(report), reply_markup=owner_panel_reply_kb())
+    await msg.reply("\n".join(report), reply_markup=OWNER_PANEL_KB)
 
 # ---------------------- Merge flow (NEW) ----------------------
-@dp.callback_query(F.data.startswith("merge_src_page:"), MergeStates.waiting_pick_src)
+@cb_route("merge_src_page", MergeStates.waiting_pick_src)
 async def merge_src_page(cb:CallbackQuery, state:FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(int(page), "merge_src"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(int(page), "merge_src"))
 
-@dp.callback_query(F.data.startswith("merge_src:"), MergeStates.waiting_pick_src)
+@cb_route("merge_src", MergeStates.waiting_pick_src)
 async def merge_pick_src(cb:CallbackQuery, state:FSMContext):
     _, src_id = cb.data.split(":",1)
     await state.update_data(src_id=int(src_id))
     await state.set_state(MergeStates.waiting_pick_dst)
-    await cb.message.edit_text("اختاري الاختبار الثاني (المصدر 2):", reply_markup=paged_quizzes_kb(0, "merge_dst"))
+    await cb.message.edit_text("اختاري الاختبار الثاني (المصدر 2):", reply_markup=await paged_quizzes_kb(0, "merge_dst"))
 
-@dp.callback_query(F.data.startswith("merge_dst_page:"), MergeStates.waiting_pick_dst)
+@cb_route("merge_dst_page", MergeStates.waiting_pick_dst)
 async def merge_dst_page(cb:CallbackQuery, state:FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(int(page), "merge_dst"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(int(page), "merge_dst"))
 
-@dp.callback_query(F.data.startswith("merge_dst:"), MergeStates.waiting_pick_dst)
+@cb_route("merge_dst", MergeStates.waiting_pick_dst)
 async def merge_do(cb:CallbackQuery, state:FSMContext):
     data = await state.get_data()
     src_id = int(data["src_id"])
     _, dst_id = cb.data.split(":",1); dst_id = int(dst_id)
     if src_id == dst_id:
         return await cb.answer("الاختباران متطابقان. اختاري اختبارًا مختلفًا.", show_alert=True)
-    new_quiz_id = merge_quizzes_create_new(src_id, dst_id)
+    new_quiz_id = await merge_quizzes_create_new(src_id, dst_id)
     await state.clear()
     await cb.message.edit_text(f"✅ تم إنشاء اختبار جديد بالدمج (ID: <code>{new_quiz_id}</code>).")
 
 # ---------------------- Export flow (NEW) ----------------------
-@dp.callback_query(F.data.startswith("export_pick_page:"), ExportStates.waiting_pick_quiz)
+@cb_route("export_pick_page", ExportStates.waiting_pick_quiz)
 async def export_pick_page(cb:CallbackQuery, state:FSMContext):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(int(page), "export_pick"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(int(page), "export_pick"))
 
-@dp.callback_query(F.data.startswith("export_pick:"), ExportStates.waiting_pick_quiz)
+@cb_route("export_pick", ExportStates.waiting_pick_quiz)
 async def export_pick(cb:CallbackQuery, state:FSMContext):
     _, quiz_id = cb.data.split(":",1)
     try:
-        data = export_quiz_json(int(quiz_id))
-        import json
-        buf = BytesIO(json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
+        payload = await export_quiz_json_bytes(int(quiz_id))
         ts = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
         filename = f"quiz_{quiz_id}_{ts}.json"
-        buf.seek(0)
-        await bot.send_document(cb.message.chat.id, document=FSInputFile(path_or_bytesio=buf, filename=filename),
+        await bot.send_document(cb.message.chat.id, document=BufferedInputFile(payload, filename=filename),
                                 caption=f"📤 تصدير اختبار ID {quiz_id}")
         await state.clear()
         await cb.answer("تم التصدير.")
@@ -1341,53 +1566,111 @@ async def export_pick(cb:CallbackQuery, state:FSMContext):
         await cb.message.edit_text(f"فشل التصدير: {e}")
 
 # ---------------------- Name & Answers ----------------------
-@dp.callback_query(F.data.startswith("start:"))
+@cb_route("start")
 async def cb_start_quiz(cb:CallbackQuery):
     try:
         _, quiz_id = cb.data.split(":",1); quiz_id = int(quiz_id)
     except Exception:
         return await cb.answer("خطأ بالمعطيات.", show_alert=True)
     chat_id = cb.message.chat.id
-    expired = _quiz_expired(chat_id, quiz_id)
+    expired = await _quiz_expired(chat_id, quiz_id)
     if expired is True: return await cb.answer("⏰ انتهى وقت الاختبار. لا يمكنك البدء.", show_alert=True)
     user_id = cb.from_user.id
-    with db() as conn:
-        row = conn.execute(
-            "SELECT 1 FROM participant_names WHERE origin_chat_id=? AND user_id=? AND quiz_id=?",
-            (chat_id, user_id, quiz_id)
-        ).fetchone()
+    row = await fetch_one("SELECT 1 FROM participant_names WHERE origin_chat_id=? AND user_id=? AND quiz_id=?",
+                          (chat_id, user_id, quiz_id))
     if not row:
-        pending_names[(chat_id, user_id, quiz_id)] = True
+        pending_names.setdefault((chat_id, user_id), set()).add(quiz_id)
         await cb.answer()
         await bot.send_message(chat_id, f"{hlink_user('الطالبة', user_id)} — من فضلك اكتبي اسمك أولاً:", disable_notification=True)
         return
     await cb.answer("بالتوفيق! ابدئي بحل الأسئلة المنشورة.")
 
-@dp.message()
+@dp.message(F.text, F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}))
 async def catch_name_in_group(msg: Message):
-    if msg.chat.type not in ("group", "supergroup"):
+    chat_id = msg.chat.id; user_id = msg.from_user.id
+    quiz_ids = pending_names.get((chat_id, user_id))
+    if not quiz_ids: return
+    name = (msg.text or "").strip()
+    if not name:
         return
-    user_id = msg.from_user.id
-    text = msg.text or ""
-    for (chat_id, uid, quiz_id), _ in list(pending_names.items()):
-        if chat_id == msg.chat.id and uid == user_id:
-            name = text.strip()
-            if not name:
-                return
-            with db() as conn:
-                conn.execute(
-                    "INSERT OR REPLACE INTO participant_names(origin_chat_id,user_id,quiz_id,name) VALUES (?,?,?,?)",
-                    (chat_id, user_id, quiz_id, name),
-                )
-                conn.commit()
-            del pending_names[(chat_id, uid, quiz_id)]
-            await msg.reply(
-                f"تم حفظ الاسم: <b>{name}</b>. يمكنك الآن البدء بالإجابة.",
-                reply_markup=ReplyKeyboardRemove(),
-            )
-            return
+    quiz_id = next(iter(quiz_ids))
+    await aexec("INSERT OR REPLACE INTO participant_names(origin_chat_id,user_id,quiz_id,name) VALUES (?,?,?,?)",
+                (chat_id, user_id, quiz_id, name))
+    quiz_ids.discard(quiz_id)
+    if not quiz_ids: pending_names.pop((chat_id, user_id), None)
+    await msg.reply(
+        f"تم حفظ الاسم: <b>{name}</b>. يمكنك الآن البدء بالإجابة.",
+        reply_markup=ReplyKeyboardRemove(),
+    )
 
-@dp.callback_query(F.data.startswith("ans:"))
+# question, the answerer's name, any previous answer and the picked/correct options in one round trip
+SQL_ANSWER_CTX = """
+WITH q AS (SELECT quiz_id, text FROM questions WHERE id=:qid)
+SELECT q.quiz_id, q.text,
+       (SELECT name FROM participant_names WHERE origin_chat_id=:c AND user_id=:u AND quiz_id=q.quiz_id) AS name,
+       EXISTS(SELECT 1 FROM responses WHERE chat_id=:c AND user_id=:u AND question_id=:qid) AS answered,
+       (SELECT json_group_array(json_array(option_index, text, is_correct)) FROM options
+         WHERE question_id=:qid AND (option_index=:opt OR is_correct=1)) AS opts
+FROM q"""
+
+SQL_UPSERT_PROGRESS = """INSERT INTO user_progress(origin_chat_id,user_id,quiz_id,q_pos,started_at,finished_at)
+                         VALUES (?,?,?,?,?,?)
+                         ON CONFLICT(origin_chat_id,user_id,quiz_id) DO UPDATE SET finished_at=excluded.finished_at"""
+
+# question ids bound as one JSON array: the SQL text is fixed, so the statement cache always hits
+SQL_FINISH_COUNT = """SELECT COUNT(DISTINCT question_id), SUM(is_correct) FROM responses
+                      WHERE chat_id=? AND user_id=? AND question_id IN (SELECT value FROM json_each(?))"""
+
+@dataclass
+class AnswerOutcome:
+    """What _record_answer found/stored; on_answer turns it into popups and messages."""
+    status: str                      # ok | missing | expired | no_name | duplicate
+    quiz_id: int = 0
+    q_brief: str = ""
+    your_text: str = "—"
+    correct_text: str = "—"
+    is_correct: int = 0
+    total_q: int = 0
+    score: Optional[int] = None      # set when this answer completed the quiz
+    name: str = "الطالبة"
+
+async def _record_answer(chat_id:int, user_id:int, question_id:int, option_index:int) -> AnswerOutcome:
+    """All DB work of one answer on a single pooled connection (no Telegram I/O while it is held)."""
+    async with pool.connection() as conn:
+        async with conn.execute(SQL_ANSWER_CTX, {"c": chat_id, "u": user_id, "qid": question_id, "opt": option_index}) as cur:
+            qrow = await cur.fetchone()
+        if not qrow: return AnswerOutcome("missing")
+        quiz_id = qrow["quiz_id"]; out = AnswerOutcome("ok", quiz_id=quiz_id)
+        if await _quiz_expired(chat_id, quiz_id, conn) is True:
+            out.status = "expired"; return out
+        if qrow["name"] is None:
+            out.status = "no_name"; return out
+        if qrow["answered"]:
+            out.status = "duplicate"; return out
+        out.name = qrow["name"]
+        for idx, text, is_correct in orjson.loads(qrow["opts"]):  # at most the picked and the correct row
+            if idx == option_index: out.your_text = text; out.is_correct = is_correct
+            if is_correct == 1: out.correct_text = text
+        q_text = qrow["text"]; out.q_brief = q_text[:80] + ("…" if len(q_text) > 80 else "")
+        ts = now_iso()
+        try:
+            await conn.execute("""INSERT INTO responses(chat_id,user_id,question_id,option_index,is_correct,answered_at)
+                                  VALUES (?,?,?,?,?,?)""",
+                               (chat_id, user_id, question_id, option_index, out.is_correct, ts))
+        except sqlite3.IntegrityError:  # a double tap raced past the check above
+            out.status = "duplicate"; return out
+
+        # check finish
+        q_ids, q_json = await get_quiz_question_ids(quiz_id, conn)
+        out.total_q = len(q_ids)
+        async with conn.execute(SQL_FINISH_COUNT, (chat_id, user_id, q_json)) as cur:
+            answered_cnt, total = await cur.fetchone()
+        if (answered_cnt or 0) != len(q_ids): return out
+        out.score = total or 0
+        await conn.execute(SQL_UPSERT_PROGRESS, (chat_id, user_id, quiz_id, 0, ts, ts))
+    return out
+
+@cb_route("ans")
 async def on_answer(cb: CallbackQuery):
     parts = cb.data.split(":", 3)
     if len(parts) < 4: return await cb.answer("خطأ.")
@@ -1398,102 +1681,48 @@ async def on_answer(cb: CallbackQuery):
     if target_user_id != 0 and user_id != target_user_id:
         return await cb.answer("هذا السؤال موجّه لمشارك آخر.")
 
-    with db() as conn:
-        qrow = conn.execute("SELECT quiz_id, text FROM questions WHERE id=?", (question_id,)).fetchone()
-        if not qrow: return await cb.answer("سؤال غير موجود.", show_alert=True)
-        quiz_id = qrow["quiz_id"]; q_text = qrow["text"]
-
-    expired = _quiz_expired(chat_id, quiz_id)
-    if expired is True: return await cb.answer("⏰ انتهى وقت الاختبار. لا يمكنك الإجابة.", show_alert=True)
-
-    with db() as conn:
-        has_name = conn.execute("SELECT 1 FROM participant_names WHERE origin_chat_id=? AND user_id=? AND quiz_id=?",
-                                (chat_id, user_id, quiz_id)).fetchone()
-    if not has_name:
-        pending_names[(chat_id, user_id, quiz_id)] = True
+    res = await _record_answer(chat_id, user_id, question_id, option_index)
+    if res.status == "missing": return await cb.answer("سؤال غير موجود.", show_alert=True)
+    if res.status == "expired": return await cb.answer("⏰ انتهى وقت الاختبار. لا يمكنك الإجابة.", show_alert=True)
+    if res.status == "no_name":
+        pending_names.setdefault((chat_id, user_id), set()).add(res.quiz_id)
         await bot.send_message(chat_id, f"{hlink_user('الطالبة', user_id)} — اكتبي اسمك أولًا ثم أعيدي اختيار الإجابة:")
         return await cb.answer()
+    if res.status == "duplicate": return await cb.answer("إجابتك مسجّلة لهذا السؤال.", show_alert=True)
 
-    with db() as conn:
-        prev = conn.execute("SELECT 1 FROM responses WHERE chat_id=? AND user_id=? AND question_id=?",
-                            (chat_id, user_id, question_id)).fetchone()
-    if prev: return await cb.answer("إجابتك مسجّلة لهذا السؤال.", show_alert=True)
-
-    with db() as conn:
-        opt = conn.execute("SELECT text, is_correct FROM options WHERE question_id=? AND option_index=?",
-                           (question_id, option_index)).fetchone()
-        all_opts = conn.execute("SELECT option_index, text, is_correct FROM options WHERE question_id=? ORDER BY option_index",
-                                (question_id,)).fetchall()
-        is_correct = 1 if opt and int(opt["is_correct"]) == 1 else 0
-        conn.execute("""INSERT INTO responses(chat_id,user_id,question_id,option_index,is_correct,answered_at)
-                        VALUES (?,?,?,?,?,?)""",
-                        (chat_id, user_id, question_id, option_index, is_correct, datetime.now(timezone.utc).isoformat()))
-        conn.commit()
-
-    your_text = opt["text"] if opt else "—"
-    correct_row = next((r for r in all_opts if int(r["is_correct"])==1), None)
-    correct_text = correct_row["text"] if correct_row else "—"
-
-    brief_q = q_text[:80] + ("…" if len(q_text) > 80 else "")
-    if is_correct:
-        feedback = f"🎉🎊 ✅ إجابة صحيحة!\nالسؤال: {brief_q}\nالصحيحة: {correct_text}\nإجابتك: {your_text}"
-    else:
-        feedback = f"❌✖️💥 إجابة خاطئة!\nالسؤال: {brief_q}\nالصحيحة: {correct_text}\nإجابتك: {your_text}"
+    head = "🎉🎊 ✅ إجابة صحيحة!" if res.is_correct else "❌✖️💥 إجابة خاطئة!"
+    feedback = f"{head}\nالسؤال: {res.q_brief}\nالصحيحة: {res.correct_text}\nإجابتك: {res.your_text}"
     if len(feedback) > 190: feedback = feedback[:187] + "…"
     await cb.answer(feedback, show_alert=True)
-    await _celebrate(chat_id, bool(is_correct))
+    await _celebrate(chat_id, bool(res.is_correct))
 
-    # check finish
-    q_ids = get_quiz_question_ids(quiz_id)
-    with db() as conn:
-        marks = ",".join(["?"] * len(q_ids))
-        sql_count = f"SELECT COUNT(DISTINCT question_id) FROM responses WHERE chat_id=? AND user_id=? AND question_id IN ({marks})"
-        answered_cnt = conn.execute(sql_count, (chat_id, user_id, *q_ids)).fetchone()[0] or 0
-    if answered_cnt == len(q_ids):
-        with db() as conn:
-            sql_score = f"SELECT SUM(is_correct) FROM responses WHERE chat_id=? AND user_id=? AND question_id IN ({marks})"
-            total = conn.execute(sql_score, (chat_id, user_id, *q_ids)).fetchone()[0] or 0
-            rowp = conn.execute("""SELECT 1 FROM user_progress WHERE origin_chat_id=? AND user_id=? AND quiz_id=?""",
-                                (chat_id, user_id, quiz_id)).fetchone()
-            if rowp:
-                conn.execute("UPDATE user_progress SET finished_at=? WHERE origin_chat_id=? AND user_id=? AND quiz_id=?",
-                             (datetime.now(timezone.utc).isoformat(), chat_id, user_id, quiz_id))
-            else:
-                conn.execute("""INSERT INTO user_progress(origin_chat_id,user_id,quiz_id,q_pos,started_at,finished_at)
-                                VALUES (?,?,?,?,?,?)""", (chat_id, user_id, quiz_id, 0, datetime.now(timezone.utc).isoformat(), datetime.now(timezone.utc).isoformat()))
-            conn.commit()
-        final_popup = f"🎆🎇 تم الإنهاء — نتيجتك: {total} / {len(q_ids)}"
+    if res.score is not None:
+        total = res.score
+        final_popup = f"🎆🎇 تم الإنهاء — نتيجتك: {total} / {res.total_q}"
         try: await cb.answer(final_popup if len(final_popup)<=190 else final_popup[:187]+"…", show_alert=True)
         except: pass
-        with db() as conn:
-            row = conn.execute("SELECT name FROM participant_names WHERE origin_chat_id=? AND user_id=? AND quiz_id=?",
-                               (chat_id, user_id, quiz_id)).fetchone()
-        _name = row["name"] if row else "الطالبة"
-        try: await bot.send_message(chat_id, f"🎉 النتيجة النهائية — {hlink_user(_name, user_id)}: <b>{total}</b> / {len(q_ids)}")
+        try: await bot.send_message(chat_id, f"🎉 النتيجة النهائية — {hlink_user(res.name, user_id)}: <b>{total}</b> / {res.total_q}")
         except TelegramBadRequest: pass
 
 # ---------------------- Scoreboard ----------------------
-@dp.callback_query(F.data.startswith("score_pickq_page:"))
+@cb_route("score_pickq_page")
 async def cb_scoreboard_page(cb:CallbackQuery):
     _, page = cb.data.split(":",1)
-    await cb.message.edit_reply_markup(reply_markup=paged_quizzes_kb(int(page), "score_pickq"))
+    await cb.message.edit_reply_markup(reply_markup=await paged_quizzes_kb(int(page), "score_pickq"))
 
-@dp.callback_query(F.data.startswith("score_pickq:"))
+@cb_route("score_pickq")
 async def cb_scoreboard_show(cb:CallbackQuery):
     _, quiz_id = cb.data.split(":",1); quiz_id = int(quiz_id)
-    chat_id = cb.message.chat.id; q_ids = get_quiz_question_ids(quiz_id)
+    chat_id = cb.message.chat.id; q_ids, q_json = await get_quiz_question_ids(quiz_id)
     if not q_ids: return await cb.answer("لا توجد أسئلة.")
-    with db() as conn:
-        q_marks = ",".join(["?"] * len(q_ids))
-        sql = f"""
-            SELECT user_id, SUM(is_correct) AS score, COUNT(*) AS answered
-            FROM responses
-            WHERE chat_id=? AND question_id IN ({q_marks})
-            GROUP BY user_id
-            ORDER BY score DESC, answered DESC
-            LIMIT 20
-        """
-        rows = conn.execute(sql, (chat_id, *q_ids)).fetchall()
+    rows = await fetch_rows("""
+        SELECT user_id, SUM(is_correct) AS score, COUNT(*) AS answered
+        FROM responses
+        WHERE chat_id=? AND question_id IN (SELECT value FROM json_each(?))
+        GROUP BY user_id
+        ORDER BY score DESC, answered DESC
+        LIMIT 20
+    """, (chat_id, q_json))
     if not rows:
         return await cb.message.edit_text("لا توجد إجابات بعد.")
     lines = ["🏆 <b>لوحة النتائج</b>"]
@@ -1502,21 +1731,31 @@ async def cb_scoreboard_show(cb:CallbackQuery):
     await cb.message.edit_text("\n".join(lines))
 
 # ---------------------- Danger Zone ----------------------
+# one transaction, children before parents; unqualified DELETEs on trigger-free,
+# FK-free tables take SQLite's truncate path instead of per-row deletes
+SQL_WIPE_ALL = """
+BEGIN IMMEDIATE;
+DELETE FROM responses;
+DELETE FROM user_progress;
+DELETE FROM participant_names;
+DELETE FROM sent_msgs;
+DELETE FROM options;
+DELETE FROM question_attachments;
+DELETE FROM questions;
+DELETE FROM media_bundle_attachments;
+DELETE FROM media_bundles;
+DELETE FROM quizzes;
+COMMIT;
+"""
+
 @dp.callback_query(F.data == "yes:wipe")
 async def cb_wipe_yes(cb:CallbackQuery):
-    with db() as conn:
-        conn.executescript("""
-            DELETE FROM responses;
-            DELETE FROM options;
-            DELETE FROM questions;
-            DELETE FROM quizzes;
-            DELETE FROM user_progress;
-            DELETE FROM sent_msgs;
-            DELETE FROM participant_names;
-            DELETE FROM question_attachments;
-            DELETE FROM media_bundle_attachments;
-            DELETE FROM media_bundles;
-        """); conn.commit()
+    async with pool.connection() as conn:
+        try: await conn.executescript(SQL_WIPE_ALL)
+        except Exception:
+            await conn.rollback(); raise
+    invalidate_question_cache(); invalidate_qids_cache(); invalidate_kb_cache()
+    EXPIRY_CACHE.clear()
     await cb.message.edit_text("تم الحذف الشامل ✅")
 
 @dp.callback_query(F.data == "no:wipe")
@@ -1524,7 +1763,7 @@ async def cb_wipe_no(cb:CallbackQuery):
     await cb.message.edit_text("تم الإلغاء.")
 
 # ---------------------- File ID helper (Owner only) ----------------------
-@dp.message(F.sticker | F.animation | F.photo | F.video | F.voice | F.audio)
+@dp.message(F.chat.type == ChatType.PRIVATE, F.sticker | F.animation | F.photo | F.video | F.voice | F.audio)
 async def show_file_id(msg: Message):
     try:
         if msg.from_user.id != OWNER_ID: return
@@ -1543,14 +1782,39 @@ async def show_file_id(msg: Message):
         else:
             return
         print(f"[file_id] {kind}: {fid}")
-        await msg.reply(f"{kind} file_id:\n<code>{fid}</code>", reply_markup=owner_panel_reply_kb())
+        await msg.reply(f"{kind} file_id:\n<code>{fid}</code>", reply_markup=OWNER_PANEL_KB)
     except Exception:
         pass
 
+# registered last so the exact-match handlers above still take precedence
+dp.callback_query.register(dispatch_callback)
+
 # ---------------------- Run ----------------------
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+async def run_webhook():
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app); await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, allowed_updates=ALLOWED_UPDATES,
+                              secret_token=WEBHOOK_SECRET or None)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     print("✅ Bot is running…")
-    await dp.start_polling(bot, allowed_updates=["message","callback_query"])
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()  # getUpdates is refused while a webhook is set
+            await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+    finally:
+        await pool.close()
 
 if __name__ == "__main__":
     try: